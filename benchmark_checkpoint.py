@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+import argparse
+
+import torch
+
+import networks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Memory / time tradeoff of gradient checkpointing the Lite-Mono stages.')
+
+    parser.add_argument('--model', type=str,
+                        help='which model to benchmark',
+                        default="lite-mono",
+                        choices=[
+                            "lite-mono",
+                            "lite-mono-small",
+                            "lite-mono-tiny",
+                            "lite-mono-8m"])
+    parser.add_argument('--height', type=int, default=320, choices=[192, 320])
+    parser.add_argument('--width', type=int, default=1024, choices=[640, 1024])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--steps', type=int, help='timed steps per configuration', default=5)
+    parser.add_argument("--no_cuda",
+                        help='if set, disables CUDA',
+                        action='store_true')
+
+    return parser.parse_args()
+
+
+def saved_activation_bytes(encoder, decoder, x):
+    """Bytes of the tensors autograd keeps for backward, measured on any device
+    """
+    total = [0]
+    seen = set()
+
+    def pack(t):
+        # parameters and views of the same storage are only counted once
+        key = (t.untyped_storage().data_ptr(), t.device)
+        if key not in seen:
+            seen.add(key)
+            total[0] += t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        outputs = decoder(encoder(x))
+    return total[0], outputs
+
+
+def benchmark(args, checkpoint_stages, device):
+    encoder = networks.LiteMono(model=args.model, height=args.height, width=args.width,
+                                checkpoint_stages=checkpoint_stages).to(device)
+    decoder = networks.DepthDecoder(encoder.num_ch_enc, range(3)).to(device)
+    encoder.train()
+    decoder.train()
+    x = torch.rand(args.batch_size, 3, args.height, args.width, device=device)
+
+    saved, outputs = saved_activation_bytes(encoder, decoder, x)
+    sum(outputs[("disp", s)].mean() for s in range(3)).backward()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.time()
+    for _ in range(args.steps):
+        outputs = decoder(encoder(x))
+        sum(outputs[("disp", s)].mean() for s in range(3)).backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    step_time = (time.time() - start) / args.steps
+
+    peak = torch.cuda.max_memory_allocated() if device.type == "cuda" else None
+    return saved, peak, step_time
+
+
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    print("{} {}x{} batch {} on {}".format(args.model, args.width, args.height, args.batch_size, device))
+    print("{:>12} | {:>14} | {:>14} | {:>10}".format("stages", "saved act. MB", "peak MB", "step s"))
+
+    baseline = None
+    for checkpoint_stages in [[], [2], [1, 2], [0, 1, 2]]:
+        saved, peak, step_time = benchmark(args, checkpoint_stages, device)
+        baseline = baseline or (saved, step_time)
+        print("{:>12} | {:>14.1f} | {:>14} | {:>10.3f}   ({:.2f}x memory, {:.2f}x time)".format(
+            str(checkpoint_stages) if checkpoint_stages else "none", saved / 2 ** 20,
+            "-" if peak is None else "{:.1f}".format(peak / 2 ** 20), step_time,
+            saved / baseline[0], step_time / baseline[1]))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
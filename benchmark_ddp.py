@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import networks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Scaling efficiency of distributed data parallel Lite-Mono training.')
+
+    parser.add_argument('--model', type=str,
+                        help='which model to benchmark',
+                        default="lite-mono",
+                        choices=[
+                            "lite-mono",
+                            "lite-mono-small",
+                            "lite-mono-tiny",
+                            "lite-mono-8m"])
+    parser.add_argument('--height', type=int, default=192, choices=[192, 320])
+    parser.add_argument('--width', type=int, default=640, choices=[640, 1024])
+    parser.add_argument('--batch_size', type=int, help='batch size per process', default=4)
+    parser.add_argument('--world_sizes', type=int, nargs='+',
+                        help='numbers of processes to benchmark', default=[1, 2, 4])
+    parser.add_argument('--steps', type=int, help='timed steps per configuration', default=10)
+    parser.add_argument('--warmup', type=int, help='untimed steps per configuration', default=3)
+    parser.add_argument('--port', type=int, default=29512)
+    parser.add_argument("--no_cuda",
+                        help='if set, disables CUDA',
+                        action='store_true')
+
+    return parser.parse_args()
+
+
+def worker(rank, world_size, args, results):
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port + world_size)
+    dist.init_process_group("nccl" if use_cuda else "gloo", rank=rank, world_size=world_size)
+    if use_cuda:
+        torch.cuda.set_device(rank)
+    device = torch.device("cuda", rank) if use_cuda else torch.device("cpu")
+    if not use_cuda:
+        # share the cores between the processes instead of oversubscribing them
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+    encoder = networks.LiteMono(model=args.model, height=args.height, width=args.width)
+    decoder = networks.DepthDecoder(encoder.num_ch_enc, range(3))
+    model = nn.Sequential(encoder, decoder).to(device)
+    if use_cuda:
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    # wrapped like Trainer.wrap_ddp, static_graph also covers the LiteMono parameters
+    # that do not contribute to the disparities
+    model = nn.parallel.DistributedDataParallel(
+        model, device_ids=[rank] if use_cuda else None, broadcast_buffers=False,
+        static_graph=True)
+    optimizer = torch.optim.AdamW(model.parameters(), 1e-4)
+    x = torch.rand(args.batch_size, 3, args.height, args.width, device=device)
+
+    def step():
+        optimizer.zero_grad()
+        outputs = model(x)
+        sum(outputs[("disp", s)].mean() for s in range(3)).backward()
+        optimizer.step()
+
+    for _ in range(args.warmup):
+        step()
+    if use_cuda:
+        torch.cuda.synchronize()
+    dist.barrier()
+
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    if use_cuda:
+        torch.cuda.synchronize()
+    step_time = torch.tensor([(time.time() - start) / args.steps])
+    # the slowest process sets the pace
+    dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+    if rank == 0:
+        results[world_size] = step_time.item()
+    dist.destroy_process_group()
+
+
+def main(args):
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    if use_cuda:
+        assert max(args.world_sizes) <= torch.cuda.device_count(), \
+            "one GPU per process, only {} available".format(torch.cuda.device_count())
+    print("{} {}x{} batch {} per process on {}".format(
+        args.model, args.width, args.height, args.batch_size, "cuda" if use_cuda else "cpu"))
+    print("{:>10} | {:>10} | {:>14} | {:>10}".format("processes", "step s", "images/s", "efficiency"))
+
+    results = mp.Manager().dict()
+    baseline = None
+    for world_size in args.world_sizes:
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size, join=True)
+        throughput = world_size * args.batch_size / results[world_size]
+        baseline = baseline or throughput / world_size
+        print("{:>10} | {:>10.3f} | {:>14.1f} | {:>9.1f}%".format(
+            world_size, results[world_size], throughput,
+            100 * throughput / (world_size * baseline)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
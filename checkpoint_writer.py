@@ -0,0 +1,160 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import torch
+
+from log_writer import LogWriter
+
+
+def to_cpu(state):
+    """Copy every tensor of a (nested) state dict to CPU memory
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread, without ever exposing a partial one
+
+    `save` snapshots the state dicts to CPU memory and returns. The writer thread then
+    saves them into a temporary directory together with a manifest.json (metrics and
+    sha256 of every file), renames it to <models_dir>/<name>_step<step>, and atomically
+    repoints the <models_dir>/<name> symlink to it. Only the `keep` most recent versions
+    of every name are kept. <models_dir>/manifest.json lists the kept versions.
+
+    A failed write leaves the previous versions untouched and drops the checkpoints
+    queued after it. Its exception is raised by the next `save`, `flush` or `close`.
+    """
+    def __init__(self, models_dir):
+        self.models_dir = models_dir
+        self.writer = LogWriter(max_queue_size=2)
+        self.error = None
+
+    def save(self, name, state_dicts, step, metrics=None, keep=1):
+        """`state_dicts` maps every file name (without .pth) to the state dict to save
+        """
+        self.raise_error()
+        snapshot = {file_name: to_cpu(state) for file_name, state in state_dicts.items()}
+        self.writer.submit(self.try_write, name, snapshot, step, metrics or {}, keep)
+
+    def try_write(self, *args):
+        """`write` on the writer thread, keeping its exception for the training thread
+        """
+        if self.error is not None:
+            return
+        try:
+            self.write(*args)
+        except Exception as e:
+            self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def write(self, name, snapshot, step, metrics, keep):
+        version = "{}_step{:08d}".format(name, step)
+        version_dir = os.path.join(self.models_dir, version)
+        tmp_dir = os.path.join(self.models_dir, ".{}.tmp".format(version))
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        try:
+            hashes = {}
+            for file_name, state in snapshot.items():
+                path = os.path.join(tmp_dir, "{}.pth".format(file_name))
+                torch.save(state, path)
+                hashes["{}.pth".format(file_name)] = file_sha256(path)
+            manifest = {"name": name, "step": step, "time": time.time(),
+                        "metrics": metrics, "sha256": hashes}
+            with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+                json.dump(manifest, f, indent=2, default=float)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.replace_dir(tmp_dir, version_dir)
+        self.point_to(name, version)
+        self.prune(name, keep)
+        self.write_index()
+
+    @staticmethod
+    def replace_dir(src, dst):
+        """Rename `src` to `dst`, moving an existing `dst` aside until `src` is in place
+        """
+        if not os.path.exists(dst):
+            os.rename(src, dst)
+            return
+        old = os.path.join(os.path.dirname(dst), ".{}.old".format(os.path.basename(dst)))
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        os.rename(dst, old)
+        try:
+            os.rename(src, dst)
+        except BaseException:
+            os.rename(old, dst)
+            raise
+        shutil.rmtree(old)
+
+    def point_to(self, name, version):
+        link = os.path.join(self.models_dir, name)
+        if os.path.isdir(link) and not os.path.islink(link):
+            # a plain directory written by an older version of the trainer
+            os.rename(link, "{}_{}".format(link, int(time.time())))
+        tmp_link = os.path.join(self.models_dir, ".{}.link".format(name))
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(version, tmp_link)
+        os.replace(tmp_link, link)
+
+    def versions(self, name):
+        prefix = "{}_step".format(name)
+        return sorted(v for v in os.listdir(self.models_dir)
+                      if v.startswith(prefix) and v[len(prefix):].isdigit())
+
+    def prune(self, name, keep):
+        for version in self.versions(name)[:-keep]:
+            shutil.rmtree(os.path.join(self.models_dir, version))
+
+    def write_index(self):
+        index = {}
+        for version in sorted(os.listdir(self.models_dir)):
+            manifest_path = os.path.join(self.models_dir, version, "manifest.json")
+            if os.path.islink(os.path.join(self.models_dir, version)) \
+                    or not os.path.isfile(manifest_path):
+                continue
+            with open(manifest_path) as f:
+                index[version] = json.load(f)
+        tmp_path = os.path.join(self.models_dir, ".manifest.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.models_dir, "manifest.json"))
+
+    def flush(self):
+        """Block until every queued checkpoint is on disk
+        """
+        self.writer.flush()
+        self.raise_error()
+
+    def close(self):
+        self.writer.close()
+        self.raise_error()
@@ -1 +1,5 @@
 from .kitti_dataset import KITTIRAWDataset, KITTIOdomDataset, KITTIDepthDataset
+from .auto_blur_cache import AutoBlurCache
+from .prefetcher import DataPrefetcher
+from .sampler import ResumableRandomSampler, TemporalLocalitySampler
+from .frame_cache import FrameCache
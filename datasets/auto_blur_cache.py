@@ -0,0 +1,100 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import hashlib
+import numpy as np
+
+import torch
+
+
+class AutoBlurCache:
+    """Applies Auto-Blur inside the dataloader and caches the blurred frames on disk
+
+    Auto-Blur is deterministic given its parameters, so every (folder, frame, side, flip)
+    frame only has to be blurred once. The blurred scales are stored as float16 in
+    <cache_dir>/<key>/<folder>/, where <key> is a hash of the dataset location, the
+    image extension and size, and the Auto-Blur and gaussian kernel parameters, so
+    changing any of them never reuses stale frames. The hashed parameters are written
+    to <cache_dir>/<key>/manifest.json and checked when the cache is opened.
+
+    Fills ("raw_color", <frame_id>, <scale>) with the unblurred colour image and replaces
+    ("color", <frame_id>, <scale>) with its auto-blurred version, as the trainer does.
+    """
+    def __init__(self, auto_blur, cache_dir, scales, height, width, data_path, img_ext):
+        self.auto_blur = auto_blur
+        self.scales = list(scales)
+
+        self.manifest = {
+            "data_path": os.path.abspath(data_path),
+            "img_ext": img_ext,
+            "height": height,
+            "width": width,
+            "receptive_field_of_hf_area": auto_blur.receptive_field_of_hf_area,
+            "hf_pixel_thresh": auto_blur.hf_pixel_thresh,
+            "hf_area_ratio": auto_blur.hf_area_ratio,
+            "gaussian_blur_kernel_size": auto_blur.gaussian_blur_kernel_size,
+            "gaussian_blur_sigma": auto_blur.gaussian_blur_sigma,
+        }
+        key = hashlib.sha1(json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, key)
+        self.check_manifest()
+
+    def check_manifest(self):
+        """Write the manifest of a new cache, or check the one of an existing cache
+        """
+        path = os.path.join(self.cache_dir, "manifest.json")
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest != self.manifest:
+                raise ValueError("Auto-Blur cache {} was written with {}, expected {}".format(
+                    self.cache_dir, manifest, self.manifest))
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def get_cache_path(self, folder, frame_index, side, do_flip):
+        return os.path.join(self.cache_dir, folder, "{}_{:010d}{}.npz".format(
+            side, frame_index, "_flip" if do_flip else ""))
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as f:
+                return {scale: torch.from_numpy(f[str(scale)].astype(np.float32))
+                        for scale in self.scales}
+        except (OSError, ValueError, KeyError):
+            # partially written by an interrupted run, recompute it
+            return None
+
+    def save(self, path, blurred):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so that concurrent workers never read a partial file
+        tmp_path = "{}.{}.tmp.npz".format(path[:-len(".npz")], os.getpid())
+        np.savez(tmp_path, **{str(scale): blurred[scale].numpy().astype(np.float16)
+                              for scale in self.scales})
+        os.replace(tmp_path, path)
+
+    def __call__(self, inputs, frames, do_flip):
+        """`frames` maps every <frame_id> to the (folder, frame_index, side) it was loaded from
+        """
+        for frame_id, (folder, frame_index, side) in frames.items():
+            path = self.get_cache_path(folder, frame_index, side, do_flip)
+            blurred = self.load(path)
+            if blurred is None:
+                with torch.no_grad():
+                    # rounded like the cached copy, so every epoch sees the same frames
+                    blurred = {scale: self.auto_blur(
+                        inputs[("color", frame_id, scale)][None])[0].half().float()
+                        for scale in self.scales}
+                self.save(path, blurred)
+
+            for scale in self.scales:
+                inputs[("raw_color", frame_id, scale)] = inputs[("color", frame_id, scale)]
+                inputs[("color", frame_id, scale)] = blurred[scale]
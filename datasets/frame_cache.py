@@ -0,0 +1,45 @@
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+
+
+class FrameCache:
+    """LRU cache of decoded frames keyed by (folder, frame_index, side), bounded in bytes
+
+    With frame_ids [0, -1, 1] every frame is loaded by three neighbouring samples, so a
+    worker that receives temporally adjacent samples (see `TemporalLocalitySampler`)
+    decodes most frames only once. Every dataloader worker holds its own cache.
+
+    The cached images are shared with the callers, which must not modify them in place.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        image = self.frames.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.frames.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        num_bytes = self.image_bytes(image)
+        if num_bytes > self.max_bytes:
+            return
+        if key in self.frames:
+            self.num_bytes -= self.image_bytes(self.frames.pop(key))
+        self.frames[key] = image
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.frames.popitem(last=False)
+            self.num_bytes -= self.image_bytes(evicted)
@@ -32,11 +32,11 @@ class KITTIDataset(MonoDataset):
 
         self.full_res_shape = (1242, 375)
         self.side_map = {"2": 2, "3": 3, "l": 2, "r": 3}
+        # image directory of every (folder, side, seg), filled lazily by get_image_dir
+        self.image_dirs = {}
 
     def check_depth(self):
-        line = self.filenames[0].split()
-        scene_name = line[0]
-        frame_index = int(line[1])
+        scene_name, frame_index, _ = self.index[0]
 
         velo_filename = os.path.join(
             self.data_path,
@@ -46,7 +46,15 @@ class KITTIDataset(MonoDataset):
         return os.path.isfile(velo_filename)
 
     def get_color(self, folder, frame_index, side, do_flip):
-        color = self.loader(self.get_image_path(folder, frame_index, side))
+        if self.frame_cache is None:
+            color = self.loader(self.get_image_path(folder, frame_index, side))
+        else:
+            # neighbouring samples decode the same frames, flipping returns a copy
+            key = (folder, frame_index, side)
+            color = self.frame_cache.get(key)
+            if color is None:
+                color = self.loader(self.get_image_path(folder, frame_index, side))
+                self.frame_cache.put(key, color)
 
         if do_flip:
             color = color.transpose(pil.FLIP_LEFT_RIGHT)
@@ -84,14 +92,20 @@ class KITTIRAWDataset(KITTIDataset):
         # =====================================
         f_str = "{:010d}{}".format(frame_index, '.png' if seg else self.img_ext)
         assert side is not None
-        if seg:
-            image_path = os.path.join(
-                self.data_path, folder, "image_0{}".format(self.side_map[side]), f_str)
-        else:
-            image_path = os.path.join(
-                self.data_path, folder, "image_0{}/data".format(self.side_map[side]), f_str)
+        image_path = os.path.join(self.get_image_dir(folder, side, seg), f_str)
         # =====================================
         return image_path
+
+    def get_image_dir(self, folder, side, seg=False):
+        key = (folder, side, seg)
+        if key not in self.image_dirs:
+            if seg:
+                self.image_dirs[key] = os.path.join(
+                    self.data_path, folder, "image_0{}".format(self.side_map[side]))
+            else:
+                self.image_dirs[key] = os.path.join(
+                    self.data_path, folder, "image_0{}/data".format(self.side_map[side]))
+        return self.image_dirs[key]
     
     '''
         Self-Supervised Monocular Depth Estimation: Solving the Edge-Fattening Problem (WACV 2023)
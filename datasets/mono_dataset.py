@@ -10,6 +10,9 @@ import torch
 import torch.utils.data as data
 from torchvision import transforms
 
+from .split_index import SplitIndex
+from .frame_cache import FrameCache
+
 
 def pil_loader(path, mode='RGB'):
     '''
@@ -38,6 +41,8 @@ class MonoDataset(data.Dataset):
         num_scales
         is_train
         img_ext
+        auto_blur_cache     optional AutoBlurCache applied to the colour images
+        frame_cache_bytes   per-worker budget of the decoded frame cache, 0 disables it
     """
     def __init__(self,
                  data_path,
@@ -47,11 +52,14 @@ class MonoDataset(data.Dataset):
                  frame_idxs,
                  num_scales,
                  is_train=False,
-                 img_ext='.jpg'):
+                 img_ext='.jpg',
+                 auto_blur_cache=None,
+                 frame_cache_bytes=0):
         super(MonoDataset, self).__init__()
 
         self.data_path = data_path
-        self.filenames = filenames
+        # parsed once, and shared read-only by the forked dataloader workers
+        self.index = SplitIndex(filenames)
         self.height = height
         self.width = width
         self.num_scales = num_scales
@@ -61,6 +69,8 @@ class MonoDataset(data.Dataset):
 
         self.is_train = is_train
         self.img_ext = img_ext
+        self.auto_blur_cache = auto_blur_cache
+        self.frame_cache = FrameCache(frame_cache_bytes) if frame_cache_bytes > 0 else None
 
         self.loader = pil_loader
         self.to_tensor = transforms.ToTensor()
@@ -123,7 +133,7 @@ class MonoDataset(data.Dataset):
                 # =====================================
 
     def __len__(self):
-        return len(self.filenames)
+        return len(self.index)
 
     def __getitem__(self, index):
         """Returns a single training item from the dataset as a dictionary.
@@ -133,6 +143,7 @@ class MonoDataset(data.Dataset):
 
             ("color", <frame_id>, <scale>)          for raw colour images,
             ("color_aug", <frame_id>, <scale>)      for augmented colour images,
+            ("raw_color", <frame_id>, <scale>)      for unblurred colour images (with auto_blur_cache),
             ("K", scale) or ("inv_K", scale)        for camera intrinsics,
             "stereo_T"                              for camera extrinsics, and
             "depth_gt"                              for ground truth depth maps.
@@ -154,25 +165,16 @@ class MonoDataset(data.Dataset):
         do_color_aug = self.is_train and random.random() > 0.5
         do_flip = self.is_train and random.random() > 0.5
 
-        line = self.filenames[index].split()
-        folder = line[0]
-
-        if len(line) == 3:
-            frame_index = int(line[1])
-        else:
-            frame_index = 0
-
-        if len(line) == 3:
-            side = line[2]
-        else:
-            side = None
+        folder, frame_index, side = self.index[index]
 
+        frames = {}
         for i in self.frame_idxs:
             if i == "s":
                 other_side = {"r": "l", "l": "r"}[side]
-                inputs[("color", i, -1)] = self.get_color(folder, frame_index, other_side, do_flip)
+                frames[i] = (folder, frame_index, other_side)
             else:
-                inputs[("color", i, -1)] = self.get_color(folder, frame_index + i, side, do_flip)
+                frames[i] = (folder, frame_index + i, side)
+            inputs[("color", i, -1)] = self.get_color(*frames[i], do_flip)
 
         '''
             Self-Supervised Monocular Depth Estimation: Solving the Edge-Fattening Problem (WACV 2023)
@@ -204,6 +206,9 @@ class MonoDataset(data.Dataset):
 
         self.preprocess(inputs, color_aug)
 
+        if self.auto_blur_cache is not None:
+            self.auto_blur_cache(inputs, frames, do_flip)
+
         for i in self.frame_idxs:
             del inputs[("color", i, -1)]
             del inputs[("color_aug", i, -1)]
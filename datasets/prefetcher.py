@@ -0,0 +1,112 @@
+from __future__ import absolute_import, division, print_function
+
+import queue
+import threading
+import time
+
+import torch
+
+
+class DataPrefetcher:
+    """Wraps a DataLoader so that the next batch is moved to the device while the
+    current one is being trained on
+
+    On CUDA the (pinned) batch N+1 is copied with non-blocking copies on a side stream,
+    and the compute stream waits on it only when the batch is handed out. On other
+    devices a background thread loads and moves the next batches into a double buffer.
+
+    `wait_time` accumulates the seconds the training loop spent waiting on data during
+    the current epoch, and `last_wait` holds the wait before the latest batch.
+    """
+    def __init__(self, loader, device, num_buffers=2):
+        self.loader = loader
+        self.device = device
+        self.num_buffers = num_buffers
+        self.wait_time = 0.0
+        self.last_wait = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        self.last_wait = 0.0
+        if self.device.type == "cuda":
+            return self.iter_cuda()
+        return self.iter_thread()
+
+    def to_device(self, inputs, non_blocking=False):
+        return {key: ipt.to(self.device, non_blocking=non_blocking)
+                for key, ipt in inputs.items()}
+
+    def record_wait(self, start):
+        self.last_wait = time.time() - start
+        self.wait_time += self.last_wait
+
+    def iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        loader_iter = iter(self.loader)
+
+        def preload():
+            start = time.time()
+            try:
+                inputs = next(loader_iter)
+            except StopIteration:
+                return None
+            finally:
+                self.record_wait(start)
+            with torch.cuda.stream(stream):
+                return self.to_device(inputs, non_blocking=True)
+
+        next_inputs = preload()
+        while next_inputs is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            inputs = next_inputs
+            for ipt in inputs.values():
+                # the copies were allocated on the side stream but are consumed on this one
+                ipt.record_stream(current_stream)
+
+            # queue the copy of the next batch before training on this one
+            next_inputs = preload()
+            yield inputs
+
+    def iter_thread(self):
+        buffer = queue.Queue(maxsize=self.num_buffers)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def load():
+            try:
+                for inputs in self.loader:
+                    if stop.is_set():
+                        return
+                    put(self.to_device(inputs))
+            except Exception as e:
+                put(e)
+                return
+            put(end)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                inputs = buffer.get()
+                self.record_wait(start)
+                if inputs is end:
+                    return
+                if isinstance(inputs, Exception):
+                    raise inputs
+                yield inputs
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy as np
+
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableRandomSampler(Sampler):
+    """Random sampler whose order only depends on the seed and the epoch, so that an
+    interrupted epoch can be resumed
+
+    `set_start` skips the first indices of the next epoch without loading them.
+    With `num_replicas` > 1 it shards every epoch like `DistributedSampler`: the shuffled
+    order is padded to a multiple of `num_replicas` and `rank` takes every
+    `num_replicas`-th index.
+    """
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = math.ceil(len(data_source) / num_replicas)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        self.start = start
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def epoch_order(self, generator):
+        """The `num_samples` indices of this rank for the current epoch
+        """
+        order = torch.randperm(len(self.data_source), generator=generator).tolist()
+        padding = self.num_samples * self.num_replicas - len(order)
+        return (order + order[:padding])[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = self.epoch_order(generator)
+        start, self.start = self.start, 0
+        return iter(order[start:])
+
+
+class TemporalLocalitySampler(ResumableRandomSampler):
+    """Shuffles runs of temporally adjacent frames, and lays them out so that every
+    dataloader worker walks along its runs, for a high `FrameCache` hit rate
+
+    The split is sorted by (folder, side, frame_index) and cut into runs of `run_length`
+    samples, whose order is shuffled every epoch. The DataLoader hands batch k to worker
+    k % num_workers, so every block of num_workers * batch_size runs is emitted one time
+    step at a time: the i-th batch slot of a worker holds the next frame of the same run
+    in each of its consecutive batches, while a batch still mixes batch_size different
+    runs.
+    """
+    def __init__(self, data_source, batch_size, num_workers, run_length,
+                 seed=0, num_replicas=1, rank=0):
+        super(TemporalLocalitySampler, self).__init__(
+            data_source, seed=seed, num_replicas=num_replicas, rank=rank)
+        self.lanes = batch_size * max(num_workers, 1)
+
+        entries = data_source.index.entries
+        order = np.lexsort((entries["frame_index"], entries["side"], entries["folder"])).tolist()
+        self.runs = [order[i:i + run_length] for i in range(0, len(order), run_length)]
+
+    def epoch_order(self, generator):
+        runs = [self.runs[i] for i in torch.randperm(len(self.runs), generator=generator).tolist()]
+        runs = runs[self.rank::self.num_replicas]
+
+        order = []
+        for block in range(0, len(runs), self.lanes):
+            lanes = runs[block:block + self.lanes]
+            for t in range(max(len(lane) for lane in lanes)):
+                order += [lane[t] for lane in lanes if t < len(lane)]
+
+        # every rank needs the same number of samples
+        order = (order + order[:self.num_samples])[:self.num_samples]
+        return order
@@ -0,0 +1,38 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+
+class SplitIndex:
+    """Compact, read-only index of the "<folder> [<frame_index> <side>]" lines of a split
+
+    The lines are parsed once into a NumPy structured array (folder id, frame index,
+    side) and a table of the distinct folders. Unlike a list of strings, reading an
+    entry does not touch a per-item Python object, so forked DataLoader workers do not
+    trigger copy-on-write of the index pages.
+    """
+    dtype = np.dtype([("folder", np.int32), ("frame_index", np.int64), ("side", "S1")])
+
+    def __init__(self, filenames):
+        folder_ids = {}
+        entries = np.empty(len(filenames), dtype=self.dtype)
+        for i, filename in enumerate(filenames):
+            line = filename.split()
+            folder_id = folder_ids.setdefault(line[0], len(folder_ids))
+            if len(line) == 3:
+                entries[i] = (folder_id, int(line[1]), line[2])
+            else:
+                entries[i] = (folder_id, 0, b"")
+
+        self.entries = entries
+        self.folders = tuple(sorted(folder_ids, key=folder_ids.get))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        """(folder, frame_index, side) of the `index`-th line, side is None when absent
+        """
+        entry = self.entries[index]
+        side = entry["side"].decode() or None
+        return self.folders[entry["folder"]], int(entry["frame_index"]), side
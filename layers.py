@@ -5,9 +5,26 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import functools
 import math
 
 
+def autocast_fp32(fn):
+    """Run `fn` in fp32 with autocast disabled, for the numerically sensitive parts of
+    a mixed precision step. Half precision tensor positional arguments are cast to fp32,
+    fp64 tensors are left as they are.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [a.float() if torch.is_tensor(a) and a.dtype in (torch.float16, torch.bfloat16)
+                else a for a in args]
+        device_type = next((a.device.type for a in args if torch.is_tensor(a)), "cpu")
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+@autocast_fp32
 def disp_to_depth(disp, min_depth, max_depth):
     """Convert network's sigmoid output into depth prediction
     The formula for this conversion is given in the 'additional considerations'
@@ -20,57 +37,50 @@ def disp_to_depth(disp, min_depth, max_depth):
     return scaled_disp, depth
 
 
+@autocast_fp32
 def transformation_from_parameters(axisangle, translation, invert=False):
     """Convert the network's (axisangle, translation) output into a 4x4 matrix
+    `invert` is either a bool or a boolean tensor with one entry per batch element.
+    The inverse is computed in closed form, [R^T | -R^T t].
     """
-    R = rot_from_axisangle(axisangle)
-    t = translation.clone()
-
-    if invert:
-        R = R.transpose(1, 2)
-        t *= -1
+    R = rot3_from_axisangle(axisangle)
+    t = translation.contiguous().view(-1, 3)
 
-    T = get_translation_matrix(t)
+    R_inv = R.transpose(1, 2)
+    t_inv = -torch.matmul(R_inv, t.unsqueeze(-1)).squeeze(-1)
 
-    if invert:
-        M = torch.matmul(R, T)
-    else:
-        M = torch.matmul(T, R)
+    if torch.is_tensor(invert):
+        invert = invert.view(-1, 1, 1)
+        R = torch.where(invert, R_inv, R)
+        t = torch.where(invert[:, 0], t_inv, t)
+    elif invert:
+        R, t = R_inv, t_inv
 
-    return M
+    return get_transformation_matrix(R, t)
 
 
-def get_translation_matrix(translation_vector):
-    """Convert a translation vector into a 4x4 transformation matrix
+def get_transformation_matrix(R, t):
+    """Assemble a Bx3x3 rotation and a Bx3 translation into Bx4x4 transformation matrices
     """
-    T = torch.zeros(translation_vector.shape[0], 4, 4).to(device=translation_vector.device)
+    bottom = R.new_tensor([0, 0, 0, 1]).expand(R.shape[0], 1, 4)
+    return torch.cat([torch.cat([R, t.unsqueeze(-1)], 2), bottom], 1)
 
-    t = translation_vector.contiguous().view(-1, 3, 1)
 
-    T[:, 0, 0] = 1
-    T[:, 1, 1] = 1
-    T[:, 2, 2] = 1
-    T[:, 3, 3] = 1
-    T[:, :3, 3, None] = t
-
-    return T
-
-
-def rot_from_axisangle(vec):
-    """Convert an axisangle rotation into a 4x4 transformation matrix
+def rot3_from_axisangle(vec):
+    """Convert an axisangle rotation into a Bx3x3 rotation matrix with Rodrigues' formula
     (adapted from https://github.com/Wallacoloo/printipi)
     Input 'vec' has to be Bx1x3
     """
-    angle = torch.norm(vec, 2, 2, True)
+    vec = vec.view(-1, 3)
+    angle = torch.norm(vec, 2, 1, True)
     axis = vec / (angle + 1e-7)
 
     ca = torch.cos(angle)
     sa = torch.sin(angle)
     C = 1 - ca
 
-    x = axis[..., 0].unsqueeze(1)
-    y = axis[..., 1].unsqueeze(1)
-    z = axis[..., 2].unsqueeze(1)
+    x, y, z = axis.unbind(1)
+    ca, sa, C = ca[:, 0], sa[:, 0], C[:, 0]
 
     xs = x * sa
     ys = y * sa
@@ -82,20 +92,11 @@ def rot_from_axisangle(vec):
     yzC = y * zC
     zxC = z * xC
 
-    rot = torch.zeros((vec.shape[0], 4, 4)).to(device=vec.device)
-
-    rot[:, 0, 0] = torch.squeeze(x * xC + ca)
-    rot[:, 0, 1] = torch.squeeze(xyC - zs)
-    rot[:, 0, 2] = torch.squeeze(zxC + ys)
-    rot[:, 1, 0] = torch.squeeze(xyC + zs)
-    rot[:, 1, 1] = torch.squeeze(y * yC + ca)
-    rot[:, 1, 2] = torch.squeeze(yzC - xs)
-    rot[:, 2, 0] = torch.squeeze(zxC - ys)
-    rot[:, 2, 1] = torch.squeeze(yzC + xs)
-    rot[:, 2, 2] = torch.squeeze(z * zC + ca)
-    rot[:, 3, 3] = 1
+    rot = torch.stack([x * xC + ca, xyC - zs, zxC + ys,
+                       xyC + zs, y * yC + ca, yzC - xs,
+                       zxC - ys, yzC + xs, z * zC + ca], 1)
 
-    return rot
+    return rot.view(-1, 3, 3)
 
 
 class ConvBlock(nn.Module):
@@ -189,6 +190,7 @@ class BackprojectDepth(nn.Module):
         self.pix_coords = nn.Parameter(torch.cat([self.pix_coords, self.ones], 1),
                                        requires_grad=False)
 
+    @autocast_fp32
     def forward(self, depth, inv_K):
         cam_points = torch.matmul(inv_K[:, :3, :3], self.pix_coords)
         cam_points = depth.view(self.batch_size, 1, -1) * cam_points
@@ -208,13 +210,17 @@ class Project3D(nn.Module):
         self.width = width
         self.eps = eps
 
+    @autocast_fp32
     def forward(self, points, K, T):
         P = torch.matmul(K, T)[:, :3, :]
 
-        cam_points = torch.matmul(P, points)
+        # source frames stacked along the batch dimension share the same points
+        P = P.view(-1, points.shape[0], 3, 4)
+        cam_points = torch.matmul(P, points.unsqueeze(0)).flatten(0, 1)
 
         pix_coords = cam_points[:, :2, :] / (cam_points[:, 2, :].unsqueeze(1) + self.eps)
-        pix_coords = pix_coords.view(self.batch_size, 2, self.height, self.width)
+        # source frames may be stacked along the batch dimension
+        pix_coords = pix_coords.view(-1, 2, self.height, self.width)
         pix_coords = pix_coords.permute(0, 2, 3, 1)
         pix_coords[..., 0] /= self.width - 1
         pix_coords[..., 1] /= self.height - 1
@@ -228,10 +234,63 @@ def upsample(x, scale_factor=2, mode="bilinear"):
     return F.interpolate(x, scale_factor=scale_factor, mode=mode)
 
 
-def get_smooth_loss(disp, img):
+class SmoothLoss(torch.autograd.Function):
+    """Edge-aware smoothness loss of the mean-normalised disparity, with a hand-written
+    backward pass
+
+    Only the disparity, its per-image mean and the two edge weight maps are kept for
+    backward, instead of the autograd graph of every intermediate gradient tensor.
+    The image is treated as a constant.
+    """
+    @staticmethod
+    def forward(ctx, disp, img):
+        scale = 1 / (disp.mean((2, 3), True) + 1e-7)
+        norm_disp = disp * scale
+
+        weight_x = (img[:, :, :, :-1] - img[:, :, :, 1:]).abs_().mean(1, True).neg_().exp_()
+        weight_y = (img[:, :, :-1, :] - img[:, :, 1:, :]).abs_().mean(1, True).neg_().exp_()
+
+        grad_x = norm_disp[:, :, :, :-1] - norm_disp[:, :, :, 1:]
+        grad_y = norm_disp[:, :, :-1, :] - norm_disp[:, :, 1:, :]
+
+        ctx.save_for_backward(disp, scale, weight_x, weight_y)
+        return (grad_x.abs_() * weight_x).mean() + (grad_y.abs_() * weight_y).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        disp, scale, weight_x, weight_y = ctx.saved_tensors
+        norm_disp = disp * scale
+
+        # d loss / d norm_disp, accumulated into a single buffer
+        grad_x = (norm_disp[:, :, :, :-1] - norm_disp[:, :, :, 1:]).sign_()
+        grad_x *= weight_x * (grad_output / weight_x.numel())
+        grad_y = (norm_disp[:, :, :-1, :] - norm_disp[:, :, 1:, :]).sign_()
+        grad_y *= weight_y * (grad_output / weight_y.numel())
+
+        grad_norm = torch.zeros_like(disp)
+        grad_norm[:, :, :, :-1] += grad_x
+        grad_norm[:, :, :, 1:] -= grad_x
+        grad_norm[:, :, :-1, :] += grad_y
+        grad_norm[:, :, 1:, :] -= grad_y
+
+        # chain through norm_disp = disp / (mean(disp) + 1e-7)
+        hw = disp.shape[2] * disp.shape[3]
+        grad_mean = (grad_norm * norm_disp).sum((2, 3), True) / hw
+        return (grad_norm - grad_mean) * scale, None
+
+
+@autocast_fp32
+def get_smooth_loss(disp, img, normalize=False):
     """Computes the smoothness loss for a disparity image
-    The color image is used for edge-aware smoothness
+    The color image is used for edge-aware smoothness.
+    With `normalize`, the disparity is first divided by its per-image mean
     """
+    if normalize and not img.requires_grad:
+        return SmoothLoss.apply(disp, img)
+
+    if normalize:
+        disp = disp / (disp.mean((2, 3), True) + 1e-7)
+
     grad_disp_x = torch.abs(disp[:, :, :, :-1] - disp[:, :, :, 1:])
     grad_disp_y = torch.abs(disp[:, :, :-1, :] - disp[:, :, 1:, :])
 
@@ -244,37 +303,66 @@ def get_smooth_loss(disp, img):
     return grad_disp_x.mean() + grad_disp_y.mean()
 
 
+class BoxFilter(torch.autograd.Function):
+    """3x3 mean filter without padding, whose backward does not keep the input
+
+    The adjoint of the filter spreads every output gradient evenly over its 3x3 window,
+    which is the same mean filter applied to the zero-padded output gradient.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        return F.avg_pool2d(x, 3, 1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return F.avg_pool2d(F.pad(grad_output, [2] * 4), 3, 1)
+
+
 class SSIM(nn.Module):
     """Layer to compute the SSIM loss between a pair of images
+
+    Only the sum of the variances enters the loss, so E[x^2] + E[y^2] is pooled as a
+    single moment, and every intermediate is released as soon as it has been used.
+    The moments are pooled with `BoxFilter`, so the pooled products are not kept
+    for backward.
     """
     def __init__(self):
         super(SSIM, self).__init__()
-        self.mu_x_pool   = nn.AvgPool2d(3, 1)
-        self.mu_y_pool   = nn.AvgPool2d(3, 1)
-        self.sig_x_pool  = nn.AvgPool2d(3, 1)
-        self.sig_y_pool  = nn.AvgPool2d(3, 1)
-        self.sig_xy_pool = nn.AvgPool2d(3, 1)
+        self.pool = BoxFilter.apply
 
         self.refl = nn.ReflectionPad2d(1)
 
         self.C1 = 0.01 ** 2
         self.C2 = 0.03 ** 2
 
+    @autocast_fp32
     def forward(self, x, y):
         x = self.refl(x)
         y = self.refl(y)
 
-        mu_x = self.mu_x_pool(x)
-        mu_y = self.mu_y_pool(y)
-
-        sigma_x  = self.sig_x_pool(x ** 2) - mu_x ** 2
-        sigma_y  = self.sig_y_pool(y ** 2) - mu_y ** 2
-        sigma_xy = self.sig_xy_pool(x * y) - mu_x * mu_y
-
-        SSIM_n = (2 * mu_x * mu_y + self.C1) * (2 * sigma_xy + self.C2)
-        SSIM_d = (mu_x ** 2 + mu_y ** 2 + self.C1) * (sigma_x + sigma_y + self.C2)
-
-        return torch.clamp((1 - SSIM_n / SSIM_d) / 2, 0, 1)
+        mu_x = self.pool(x)
+        mu_y = self.pool(y)
+        sigma_sq = self.pool((x * x).addcmul_(y, y))
+        sigma_xy = self.pool(x * y)
+        del x, y
+
+        mu_xy = mu_x * mu_y
+        mu_sq = (mu_x * mu_x).addcmul_(mu_y, mu_y)
+        del mu_x, mu_y
+
+        # the pooled moments are not needed for backward and are updated in place
+        SSIM_n = (2 * mu_xy + self.C1) * sigma_xy.sub_(mu_xy).mul_(2).add_(self.C2)
+        del mu_xy, sigma_xy
+        SSIM_d = (mu_sq + self.C1) * sigma_sq.sub_(mu_sq).add_(self.C2)
+        del mu_sq, sigma_sq
+
+        return torch.clamp((SSIM_n / SSIM_d).neg_().add_(1).mul_(0.5), 0, 1)
+
+    def photometric_loss(self, x, y, alpha=0.85):
+        """Fused `alpha * ssim + (1 - alpha) * l1` loss, averaged over the channels
+        """
+        l1_loss = torch.abs(y - x).mean(1, True)
+        return alpha * self(x, y).mean(1, True) + (1 - alpha) * l1_loss
 
 
 def compute_depth_errors(gt, pred):
@@ -0,0 +1,43 @@
+from __future__ import absolute_import, division, print_function
+
+import queue
+import threading
+
+
+class LogWriter:
+    """Runs logging calls (tensorboard, wandb) on a background thread
+
+    Calls are queued with `submit` and executed in order. The queue is bounded, so a
+    writer that falls behind applies back-pressure instead of buffering an unbounded
+    amount of host memory. Exceptions raised by a call are printed and do not stop
+    the thread.
+    """
+    def __init__(self, max_queue_size=8):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                fn(*args, **kwargs)
+            except Exception as e:
+                print("Logging failed: {!r}".format(e))
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self):
+        """Block until every submitted call has been executed
+        """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
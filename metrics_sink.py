@@ -0,0 +1,101 @@
+from __future__ import absolute_import, division, print_function
+
+import abc
+import json
+import os
+import time
+
+from tensorboardX import SummaryWriter
+
+
+class MetricsSink(abc.ABC):
+    """Destination of the run level metrics (losses, learning rates, best scores)
+
+    Sinks are only called from the trainer's log writer thread, so they may block on
+    I/O without adding latency to a training step.
+    """
+    @abc.abstractmethod
+    def log(self, metrics, step):
+        pass
+
+    def watch(self, model):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullSink(MetricsSink):
+    """Drops every metric, used on the non-main ranks of distributed training
+    """
+    def log(self, metrics, step):
+        pass
+
+
+class TensorboardSink(MetricsSink):
+    """Writes every metric as a tensorboard scalar into <log_path>/metrics
+    """
+    def __init__(self, log_path):
+        self.writer = SummaryWriter(os.path.join(log_path, "metrics"))
+
+    def log(self, metrics, step):
+        for name, value in metrics.items():
+            self.writer.add_scalar(name, value, step)
+
+    def close(self):
+        self.writer.close()
+
+
+class JSONLSink(MetricsSink):
+    """Appends one {"step", "time", <metrics>} record per call to <log_path>/metrics.jsonl
+
+    Records are buffered and written in batches of `flush_every`, and on close.
+    """
+    def __init__(self, log_path, flush_every=50):
+        os.makedirs(log_path, exist_ok=True)
+        self.path = os.path.join(log_path, "metrics.jsonl")
+        self.flush_every = flush_every
+        self.buffer = []
+
+    def log(self, metrics, step):
+        record = {"step": step, "time": time.time()}
+        record.update(metrics)
+        self.buffer.append(json.dumps(record, default=float))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, "a") as f:
+                f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class WandbSink(MetricsSink):
+    """Forwards the metrics to wandb, which is only imported when this sink is used
+    """
+    def __init__(self, project, name):
+        import wandb
+        self.run = wandb.init(project=project, name=name)
+
+    def log(self, metrics, step):
+        self.run.log(metrics, step=step)
+
+    def watch(self, model):
+        self.run.watch(model)
+
+    def close(self):
+        self.run.finish()
+
+
+def make_metrics_sink(backend, log_path, model_name):
+    if backend == "tensorboard":
+        return TensorboardSink(log_path)
+    if backend == "jsonl":
+        return JSONLSink(log_path)
+    if backend == "wandb":
+        return WandbSink("Lite-Mono", model_name)
+    raise ValueError("unknown metrics backend '{}'".format(backend))
@@ -2,4 +2,5 @@ from .resnet_encoder import ResnetEncoder
 from .pose_decoder import PoseDecoder
 from .depth_decoder import DepthDecoder
 from .depth_encoder import LiteMono
-from .auto_blur import AutoBlurModule
\ No newline at end of file
+from .auto_blur import AutoBlurModule
+from .random_mask import RandomMaskModule
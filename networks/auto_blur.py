@@ -5,8 +5,8 @@ This is the source code of:
 '''
 import torch
 import torch.nn as nn
-from torchvision import transforms
 import torch.nn.functional as F
+from layers import autocast_fp32
 
 # AutoBlur: AutoBlur main module source code
 class AutoBlurModule(nn.Module):
@@ -15,15 +15,25 @@ class AutoBlurModule(nn.Module):
                  hf_area_percent_thresh=60,
                  gaussian_blur_kernel_size=11,
                  gaussian_blur_sigma=5.0,
+                 tile_size=32,
                  ):
         super(AutoBlurModule, self).__init__()
 
         self.receptive_field_of_hf_area = receptive_field_of_hf_area
         self.hf_pixel_thresh = hf_pixel_thresh
         self.hf_area_ratio = hf_area_percent_thresh / 100
+        # Only tiles containing high frequency area are blurred; 0 blurs the whole image.
+        self.tile_size = tile_size
+
+        # Separable gaussian kernel, identical to torchvision's GaussianBlur kernel.
+        self.gaussian_blur_kernel_size = gaussian_blur_kernel_size
+        self.gaussian_blur_sigma = gaussian_blur_sigma
+        self.gaussian_blur_pad = gaussian_blur_kernel_size // 2
+        x = torch.linspace(-self.gaussian_blur_pad, self.gaussian_blur_pad,
+                           steps=gaussian_blur_kernel_size)
+        pdf = torch.exp(-0.5 * (x / gaussian_blur_sigma) ** 2)
+        self.register_buffer('gaussian_kernel', pdf / pdf.sum(), persistent=False)
 
-        self.gaussian_blur = transforms.GaussianBlur(gaussian_blur_kernel_size,
-                                                     sigma=gaussian_blur_sigma)
         self.avg_pool = nn.AvgPool2d(
             kernel_size=receptive_field_of_hf_area, stride=1,
             padding=(receptive_field_of_hf_area - 1) // 2)
@@ -39,10 +49,47 @@ class AutoBlurModule(nn.Module):
         grad_l2_norm = torch.sqrt(grad_u ** 2 + grad_v ** 2)
         return grad_l2_norm
 
-    def forward(self, raw_img):
-        # Gaussian blur the whole image first.
-        blurred_img = self.gaussian_blur(raw_img)
+    def separable_blur(self, padded_img):
+        """Gaussian blur an already reflection-padded image with two 1-D passes
+        """
+        c = padded_img.shape[1]
+        k = self.gaussian_kernel.to(padded_img.dtype)
+        blurred = F.conv2d(padded_img, k.view(1, 1, 1, -1).expand(c, 1, 1, k.shape[0]), groups=c)
+        blurred = F.conv2d(blurred, k.view(1, 1, -1, 1).expand(c, 1, k.shape[0], 1), groups=c)
+        return blurred
+
+    def gaussian_blur(self, raw_img, weight_blur):
+        """Gaussian blur the image wherever `weight_blur` is non-zero.
+        Elsewhere the raw image is returned, as it is not blended in anyway.
+        """
+        padded_img = F.pad(raw_img, [self.gaussian_blur_pad] * 4, mode='reflect')
+        if not self.tile_size:
+            return self.separable_blur(padded_img)
+
+        b, c, h, w = raw_img.shape
+        t = self.tile_size
+        num_y, num_x = -(-h // t), -(-w // t)
+        extra = [0, num_x * t - w, 0, num_y * t - h]
+
+        # tiles with any high frequency area
+        is_active = F.max_pool2d(F.pad(weight_blur, extra), t) > 0
+        tile_b, _, tile_y, tile_x = is_active.nonzero(as_tuple=True)
 
+        blurred = F.pad(raw_img, extra)
+        if len(tile_b) == 0:
+            return blurred[:, :, :h, :w]
+
+        # overlapping (t + 2 * pad)^2 windows of the padded image, one per output tile
+        window = t + 2 * self.gaussian_blur_pad
+        windows = F.pad(padded_img, extra).unfold(2, window, t).unfold(3, window, t)
+        tiles = self.separable_blur(windows[tile_b, :, tile_y, tile_x])
+
+        blurred.view(b, c, num_y, t, num_x, t).permute(0, 2, 4, 1, 3, 5)[
+            tile_b, tile_y, tile_x] = tiles
+        return blurred[:, :, :h, :w]
+
+    @autocast_fp32
+    def forward(self, raw_img):
         # Whether it is a high frequency pixel.
         spatial_grad = self.compute_spatial_grad(raw_img)
         is_hf_pixel = spatial_grad > self.hf_pixel_thresh
@@ -56,6 +103,9 @@ class AutoBlurModule(nn.Module):
 
         weight_blur = avg_pool_freq * is_in_hf_area
 
+        # Gaussian blur the high frequency regions.
+        blurred_img = self.gaussian_blur(raw_img, weight_blur)
+
         # Only pixels located in high frequency regions are
         # gaussian blurred, with other pixels unchanged.
         # The more the avg freq, the more the pixel is blurred.
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 from timm.models.layers import DropPath
 import math
 import torch.cuda
+from torch.utils.checkpoint import checkpoint
 
 
 class PositionalEncodingFourier(nn.Module):
@@ -104,11 +105,9 @@ class LayerNorm(nn.Module):
         if self.data_format == "channels_last":
             return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
         elif self.data_format == "channels_first":
-            u = x.mean(1, keepdim=True)
-            s = (x - u).pow(2).mean(1, keepdim=True)
-            x = (x - u) / torch.sqrt(s + self.eps)
-            x = self.weight[:, None, None] * x + self.bias[:, None, None]
-            return x
+            # (N, C, H, W) -> (N, H, W, C) is a free view for channels_last tensors
+            x = F.layer_norm(x.permute(0, 2, 3, 1), self.normalized_shape, self.weight, self.bias, self.eps)
+            return x.permute(0, 3, 1, 2)
 
 
 class BNGELU(nn.Module):
@@ -205,6 +204,8 @@ class DilatedConv(nn.Module):
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
     def forward(self, x):
+        # x is expected in channels_last memory format (see LiteMono.forward_stage),
+        # so that both permutes are free views and no copies are made.
         input = x
 
         x = self.ddwconv(x)
@@ -251,6 +252,8 @@ class LGFI(nn.Module):
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
     def forward(self, x):
+        # x is expected in channels_last memory format (see LiteMono.forward_stage),
+        # so that the reshapes and permutes are free views and no copies are made.
         input_ = x
 
         # XCA
@@ -279,6 +282,31 @@ class LGFI(nn.Module):
         return x
 
 
+def checkpoint_block(block, x):
+    """
+    Run `block` with gradient checkpointing: its activations are recomputed during backward
+    instead of being stored. BatchNorm running statistics are only updated by the first pass.
+    """
+    is_recompute = [False]
+
+    def run(x):
+        if not is_recompute[0]:
+            is_recompute[0] = True
+            return block(x)
+
+        bns = [m for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        momenta = [m.momentum for m in bns]
+        for m in bns:
+            m.momentum = 0.
+        try:
+            return block(x)
+        finally:
+            for m, momentum in zip(bns, momenta):
+                m.momentum = momentum
+
+    return checkpoint(run, x, use_reentrant=False)
+
+
 class AvgPool(nn.Module):
     def __init__(self, ratio):
         super().__init__()
@@ -300,10 +328,13 @@ class LiteMono(nn.Module):
     def __init__(self, in_chans=3, model='lite-mono', height=192, width=640,
                  global_block=[1, 1, 1], global_block_type=['LGFI', 'LGFI', 'LGFI'],
                  drop_path_rate=0.2, layer_scale_init_value=1e-6, expan_ratio=6,
-                 heads=[8, 8, 8], use_pos_embd_xca=[True, False, False], **kwargs):
+                 heads=[8, 8, 8], use_pos_embd_xca=[True, False, False], checkpoint_stages=(), **kwargs):
 
         super().__init__()
 
+        # stages whose blocks are run with gradient checkpointing during training
+        self.checkpoint_stages = list(checkpoint_stages)
+
         if model == 'lite-mono':
             self.num_ch_enc = np.array([48, 80, 128])
             self.depth = [4, 4, 10]
@@ -404,6 +435,16 @@ class LiteMono(nn.Module):
             nn.init.constant_(m.weight, 1)
             nn.init.constant_(m.bias, 0)
 
+    def forward_stage(self, i, x):
+        # Activations stay channels_last within a stage: the depthwise convolutions run on
+        # channels_last tensors and the pointwise layers on the same buffer viewed as (N, H, W, C).
+        x = x.contiguous(memory_format=torch.channels_last)
+
+        use_checkpoint = i in self.checkpoint_stages and self.training and torch.is_grad_enabled()
+        for block in self.stages[i]:
+            x = checkpoint_block(block, x) if use_checkpoint else block(x)
+        return x.contiguous()
+
     def forward_features(self, x):
         features = []
         x = (x - 0.45) / 0.225
@@ -417,9 +458,7 @@ class LiteMono(nn.Module):
         x = self.stem2(torch.cat((x, x_down[0]), dim=1))
         tmp_x.append(x)
 
-        for s in range(len(self.stages[0])-1):
-            x = self.stages[0][s](x)
-        x = self.stages[0][-1](x)
+        x = self.forward_stage(0, x)
         tmp_x.append(x)
         features.append(x)
 
@@ -429,9 +468,7 @@ class LiteMono(nn.Module):
             x = self.downsample_layers[i](x)
 
             tmp_x = [x]
-            for s in range(len(self.stages[i]) - 1):
-                x = self.stages[i][s](x)
-            x = self.stages[i][-1](x)
+            x = self.forward_stage(i, x)
             tmp_x.append(x)
 
             features.append(x)
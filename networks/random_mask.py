@@ -0,0 +1,45 @@
+'''
+    PoseNet image preprocessing with random masking
+'''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# MASK: Random masking of the PoseNet inputs
+class RandomMaskModule(nn.Module):
+    def __init__(self, mask_ratio, patch_size=1, seed=None):
+        super(RandomMaskModule, self).__init__()
+
+        self.mask_ratio = mask_ratio
+        # masking granularity: pixels are masked in patch_size x patch_size blocks
+        self.patch_size = patch_size
+        self.seed = seed
+        self.generators = {}
+
+    def get_generator(self, device):
+        # one seeded generator per device, the default generator when no seed is given
+        if self.seed is None:
+            return None
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed)
+        return self.generators[device]
+
+    def forward(self, x, batch_size=None):
+        """Mask the images `x` (N, C, H, W) out of place, with a single multiply.
+
+        The N images are treated as N / batch_size stacked groups (e.g. frames) of
+        batch_size images, and every group receives the same mask.
+        """
+        n, c, h, w = x.shape
+        b = n if batch_size is None else batch_size
+        p = self.patch_size
+
+        noise = torch.randn(b, 1, -(-h // p), -(-w // p), device=x.device,
+                            generator=self.get_generator(x.device))
+        keep = (noise > self.mask_ratio).to(x.dtype)
+        if p > 1:
+            keep = F.interpolate(keep, scale_factor=p, mode='nearest')[:, :, :h, :w]
+
+        return (x.view(n // b, b, c, h, w) * keep).view(n, c, h, w)
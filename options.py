@@ -34,6 +34,10 @@ class LiteMonoOptions:
                                  type=float,
                                  choices=[0.3, 0.5, 0.7],
                                  help="PoseNet image preprocessing with random masking ratio, with [30%, 50%, 70% masking ratio]")
+        self.parser.add_argument("--mask_patch_size",
+                                 default=1,
+                                 type=int,
+                                 help="PoseNet random masking granularity, pixels are masked in square patches of this size")
         # =====================================
         
         '''
@@ -60,6 +64,15 @@ class LiteMonoOptions:
                                  default=0.2)
         self.parser.add_argument("--hf_area_percent_thresh",
                                  type=int, default=60)
+        self.parser.add_argument("--auto_blur_tile_size",
+                                 type=int,
+                                 help="only tiles of this size containing high frequency area "
+                                      "are blurred in Auto-Blur, 0 blurs the whole image",
+                                 default=32)
+        self.parser.add_argument("--auto_blur_cache",
+                                 type=str,
+                                 help="if set, Auto-Blur runs in the dataloader and the blurred "
+                                      "training frames are cached in this folder")
         self.parser.add_argument("--ambiguity_by_negative_exponential",
                                  help='if set, use negative exponential '
                                       'to replace threshold',
@@ -88,6 +101,10 @@ class LiteMonoOptions:
         self.parser.add_argument("--sgt_isolated_margin", type=float, default=0.65, help='margin for isolated sgt loss')
         self.parser.add_argument("--sgt_kernel_size", type=int, nargs='+', default=[5, 5, 5],
                                  help='kernel size (local patch size) for sgt loss')
+        self.parser.add_argument("--sgt_sparse",
+                                 help="if set, computes the sgt loss only on the gathered "
+                                      "neighbourhoods of the segmentation boundary pixels",
+                                 default=False, action="store_true")
         # =====================================
         
         # TRAINING options
@@ -166,9 +183,14 @@ class LiteMonoOptions:
                                  default=[0, -1, 1])
 
         self.parser.add_argument("--profile",
-                                 type=bool,
-                                 help="profile once at the beginning of the training",
-                                 default=True)
+                                 help="if set profiles a window of steps at the beginning of "
+                                      "the training with torch.profiler",
+                                 action="store_true")
+        self.parser.add_argument("--profile_steps",
+                                 nargs=3,
+                                 type=int,
+                                 help="wait, warmup and active steps of the profiling window",
+                                 default=[5, 5, 10])
 
         # OPTIMIZATION options
         self.parser.add_argument("--batch_size",
@@ -222,6 +244,10 @@ class LiteMonoOptions:
                                  help="how many images the pose network gets",
                                  default="pairs",
                                  choices=["pairs", "all"])
+        self.parser.add_argument("--batch_pose_encoder",
+                                 help="if set, the frame pairs of all source frames go through the "
+                                      "pose encoder as one batch, sharing its BatchNorm statistics",
+                                 action="store_true")
         self.parser.add_argument("--pose_model_type",
                                  type=str,
                                  help="normal or shared",
@@ -232,6 +258,36 @@ class LiteMonoOptions:
         self.parser.add_argument("--no_cuda",
                                  help="if set disables CUDA",
                                  action="store_true")
+        self.parser.add_argument("--mixed_precision",
+                                 type=str,
+                                 help="mixed precision training with autocast, "
+                                      "fp16 (with loss scaling, CUDA only) or bf16",
+                                 default="none",
+                                 choices=["none", "fp16", "bf16"])
+        self.parser.add_argument("--checkpoint_stages",
+                                 nargs="*",
+                                 type=int,
+                                 help="LiteMono stages (0, 1, 2) to run with gradient checkpointing, "
+                                      "trading recompute for activation memory",
+                                 default=[],
+                                 choices=[0, 1, 2])
+        self.parser.add_argument("--frame_cache_mb",
+                                 type=int,
+                                 help="per-worker budget in MB of the LRU cache of decoded "
+                                      "training frames, 0 disables it",
+                                 default=0)
+        self.parser.add_argument("--temporal_run_length",
+                                 type=int,
+                                 help="if > 0, shuffles runs of this many temporally adjacent "
+                                      "samples and keeps each run on one dataloader worker, "
+                                      "to raise the frame cache hit rate",
+                                 default=0)
+        self.parser.add_argument("--ddp_backend",
+                                 type=str,
+                                 help="process group backend when launched with torchrun, "
+                                      "auto picks nccl on CUDA and gloo otherwise",
+                                 default="auto",
+                                 choices=["auto", "nccl", "gloo"])
         self.parser.add_argument("--num_workers",
                                  type=int,
                                  help="number of dataloader workers",
@@ -241,6 +297,10 @@ class LiteMonoOptions:
         self.parser.add_argument("--load_weights_folder",
                                  type=str,
                                  help="name of model to load")
+        self.parser.add_argument("--resume",
+                                 help="if set also restores the training state (schedule, step, "
+                                      "best metrics, RNG) of the load_weights_folder checkpoint",
+                                 action="store_true")
         self.parser.add_argument("--models_to_load",
                                  nargs="+",
                                  type=str,
@@ -256,6 +316,29 @@ class LiteMonoOptions:
                                  type=int,
                                  help="number of epochs between each save",
                                  default=1)
+        self.parser.add_argument("--save_step_frequency",
+                                 type=int,
+                                 help="number of steps between each mid-epoch checkpoint, "
+                                      "0 only saves at the end of epochs",
+                                 default=0)
+        self.parser.add_argument("--num_checkpoints",
+                                 type=int,
+                                 help="number of most recent checkpoints to keep",
+                                 default=3)
+        self.parser.add_argument("--metrics_backend",
+                                 type=str,
+                                 help="where the run level metrics are logged, the local "
+                                      "backends need no network access",
+                                 default="wandb",
+                                 choices=["wandb", "tensorboard", "jsonl"])
+        self.parser.add_argument("--timing_frequency",
+                                 type=int,
+                                 help="number of steps between each export of the step timing "
+                                      "percentiles, 0 disables the timers",
+                                 default=0)
+        self.parser.add_argument("--timing_sync",
+                                 help="if set synchronizes CUDA around every timed section",
+                                 action="store_true")
 
         # EVALUATION options
         self.parser.add_argument("--disable_median_scaling",
@@ -290,4 +373,6 @@ class LiteMonoOptions:
 
     def parse(self):
         self.options = self.parser.parse_args()
+        if self.options.mask_patch_size < 1:
+            self.parser.error("--mask_patch_size must be at least 1")
         return self.options
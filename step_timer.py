@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+
+class StepTimer:
+    """Named wall-clock timers around the parts of a training step
+
+    Sections are timed with `with timer("name"):` and externally measured durations
+    are added with `timer.add("name", seconds)`. Every `frequency` steps the recorded
+    durations are aggregated into per-section percentiles, which can be written to
+    tensorboard and appended to a JSON lines file.
+
+    When disabled, `timer("name")` returns a shared null context and nothing is recorded.
+    With `sync`, CUDA is synchronized around every section so that asynchronous kernels
+    are attributed to the section that launched them.
+    """
+    percentiles = (50, 90, 99)
+
+    def __init__(self, frequency=0, sync=False, json_path=None):
+        self.enabled = frequency > 0
+        self.frequency = frequency
+        self.sync = sync and torch.cuda.is_available()
+        self.json_path = json_path
+        self.null_context = contextlib.nullcontext()
+        self.durations = defaultdict(list)
+        self.num_steps = 0
+
+    def __call__(self, name):
+        if not self.enabled:
+            return self.null_context
+        return self.section(name)
+
+    @contextlib.contextmanager
+    def section(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.durations[name].append(time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.durations[name].append(seconds)
+
+    def step(self):
+        """Mark the end of a training step. Returns the aggregated summary every
+        `frequency` steps, and None otherwise
+        """
+        if not self.enabled:
+            return None
+        self.num_steps += 1
+        if self.num_steps % self.frequency != 0:
+            return None
+        summary = self.summarize()
+        self.durations.clear()
+        return summary
+
+    def summarize(self):
+        """{section: {"mean", "total", "p50", "p90", "p99"}} in milliseconds, where
+        "total" is the time per step
+        """
+        summary = {}
+        for name, durations in self.durations.items():
+            durations = np.array(durations) * 1000
+            stats = {"mean": float(durations.mean()),
+                     "total": float(durations.sum() / self.frequency)}
+            for p, value in zip(self.percentiles, np.percentile(durations, self.percentiles)):
+                stats["p{}".format(p)] = float(value)
+            summary[name] = stats
+        return summary
+
+    def write(self, summary, step, writer=None):
+        """Export a summary returned by `step` to tensorboard and the JSON lines file
+        """
+        if writer is not None:
+            for name, stats in summary.items():
+                for stat, value in stats.items():
+                    writer.add_scalar("timing/{}/{}".format(name, stat), value, step)
+        if self.json_path is not None:
+            with open(self.json_path, "a") as f:
+                f.write(json.dumps({"step": step, "timing_ms": summary}) + "\n")
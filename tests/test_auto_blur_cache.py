@@ -0,0 +1,39 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+
+import pytest
+
+import datasets
+import networks
+
+
+def make_cache(cache_dir, data_path="kitti_data", img_ext=".jpg", **kwargs):
+    auto_blur = networks.AutoBlurModule(9, **kwargs)
+    return datasets.AutoBlurCache(auto_blur, str(cache_dir), [0, 1], 192, 640, data_path, img_ext)
+
+
+def test_cache_key_covers_every_parameter(tmp_path):
+    cache = make_cache(tmp_path)
+    others = [make_cache(tmp_path, data_path="other_data"),
+              make_cache(tmp_path, img_ext=".png"),
+              make_cache(tmp_path, gaussian_blur_kernel_size=7),
+              make_cache(tmp_path, gaussian_blur_sigma=3.0)]
+
+    cache_dirs = {cache.cache_dir} | {other.cache_dir for other in others}
+    assert len(cache_dirs) == 5
+    assert make_cache(tmp_path).cache_dir == cache.cache_dir
+
+    with open(os.path.join(cache.cache_dir, "manifest.json")) as f:
+        assert json.load(f) == cache.manifest
+
+
+def test_mismatched_manifest_is_rejected(tmp_path):
+    cache = make_cache(tmp_path)
+    path = os.path.join(cache.cache_dir, "manifest.json")
+    with open(path, "w") as f:
+        json.dump(dict(cache.manifest, gaussian_blur_sigma=1.0), f)
+
+    with pytest.raises(ValueError):
+        make_cache(tmp_path)
@@ -0,0 +1,55 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import pytest
+import torch
+
+from checkpoint_writer import CheckpointWriter
+
+
+def listing(models_dir):
+    return sorted(os.listdir(models_dir))
+
+
+def test_keeps_the_latest_versions(tmp_path):
+    writer = CheckpointWriter(str(tmp_path))
+    for step in range(3):
+        writer.save("weights", {"encoder": {"w": torch.full((2,), step)}}, step, keep=2)
+    writer.close()
+
+    assert listing(tmp_path) == ["manifest.json", "weights",
+                                 "weights_step00000001", "weights_step00000002"]
+    assert os.readlink(tmp_path / "weights") == "weights_step00000002"
+    assert torch.load(tmp_path / "weights" / "encoder.pth")["w"].tolist() == [2, 2]
+
+
+def test_failed_write_is_raised_and_keeps_previous_versions(tmp_path):
+    writer = CheckpointWriter(str(tmp_path))
+    writer.save("weights", {"encoder": {"w": torch.zeros(2)}}, 0)
+    writer.flush()
+
+    with pytest.raises(RuntimeError):
+        # not picklable
+        writer.save("weights", {"encoder": {"w": lambda: None}}, 1)
+        # raises if the failure is already known, or is dropped by the writer thread
+        writer.save("weights", {"encoder": {"w": torch.ones(2)}}, 2)
+        writer.flush()
+
+    # nothing is rotated or pruned after the failed write
+    assert listing(tmp_path) == ["manifest.json", "weights", "weights_step00000000"]
+    assert os.readlink(tmp_path / "weights") == "weights_step00000000"
+
+    writer.save("weights", {"encoder": {"w": torch.ones(2)}}, 3)
+    writer.close()
+    assert os.readlink(tmp_path / "weights") == "weights_step00000003"
+
+
+def test_rewriting_a_version_replaces_it(tmp_path):
+    writer = CheckpointWriter(str(tmp_path))
+    writer.save("weights", {"encoder": {"w": torch.zeros(2)}}, 5)
+    writer.save("weights", {"encoder": {"w": torch.ones(2)}}, 5)
+    writer.close()
+
+    assert listing(tmp_path) == ["manifest.json", "weights", "weights_step00000005"]
+    assert torch.load(tmp_path / "weights" / "encoder.pth")["w"].tolist() == [1, 1]
@@ -0,0 +1,56 @@
+from __future__ import absolute_import, division, print_function
+
+from PIL import Image
+
+from datasets import FrameCache
+
+
+def frame(width=4, height=2, mode="RGB"):
+    return Image.new(mode, (width, height))
+
+
+def test_hits_and_misses():
+    cache = FrameCache(max_bytes=1000)
+    assert cache.get(("a", 0, "l")) is None
+    image = frame()
+    cache.put(("a", 0, "l"), image)
+    assert cache.get(("a", 0, "l")) is image
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.num_bytes == 4 * 2 * 3
+
+
+def test_evicts_least_recently_used_by_bytes():
+    # room for 3 frames of 24 bytes
+    cache = FrameCache(max_bytes=80)
+    for i in range(3):
+        cache.put(i, frame())
+    cache.get(0)
+    cache.put(3, frame())
+    assert list(cache.frames) == [2, 0, 3]
+    assert cache.num_bytes == 72
+
+    # a frame of 2 x 24 bytes evicts the 2 least recently used ones
+    cache.put(4, frame(width=8))
+    assert list(cache.frames) == [3, 4]
+    assert cache.num_bytes == 72
+
+
+def test_overwrite_replaces_bytes():
+    cache = FrameCache(max_bytes=80)
+    cache.put(0, frame())
+    cache.put(1, frame())
+    cache.put(0, frame(mode="L"))
+    assert list(cache.frames) == [1, 0]
+    assert cache.num_bytes == 24 + 8
+
+    cache.put(0, frame(width=8))
+    assert cache.num_bytes == 24 + 48
+    assert list(cache.frames) == [1, 0]
+
+
+def test_frame_larger_than_cache_is_not_stored():
+    cache = FrameCache(max_bytes=20)
+    cache.put(0, frame(mode="L"))
+    cache.put(1, frame())
+    assert list(cache.frames) == [0]
+    assert cache.num_bytes == 8
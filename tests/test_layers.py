@@ -0,0 +1,303 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+import torch
+import torch.nn as nn
+
+from layers import SSIM, BoxFilter, get_smooth_loss, rot3_from_axisangle, transformation_from_parameters
+
+
+def reference_rot_from_axisangle(vec):
+    """The 4x4 axisangle rotation that `rot3_from_axisangle` replaces
+    """
+    angle = torch.norm(vec, 2, 2, True)
+    axis = vec / (angle + 1e-7)
+
+    ca = torch.cos(angle)
+    sa = torch.sin(angle)
+    C = 1 - ca
+
+    x = axis[..., 0].unsqueeze(1)
+    y = axis[..., 1].unsqueeze(1)
+    z = axis[..., 2].unsqueeze(1)
+
+    xs = x * sa
+    ys = y * sa
+    zs = z * sa
+    xC = x * C
+    yC = y * C
+    zC = z * C
+    xyC = x * yC
+    yzC = y * zC
+    zxC = z * xC
+
+    rot = torch.zeros((vec.shape[0], 4, 4), dtype=vec.dtype, device=vec.device)
+
+    rot[:, 0, 0] = torch.squeeze(x * xC + ca)
+    rot[:, 0, 1] = torch.squeeze(xyC - zs)
+    rot[:, 0, 2] = torch.squeeze(zxC + ys)
+    rot[:, 1, 0] = torch.squeeze(xyC + zs)
+    rot[:, 1, 1] = torch.squeeze(y * yC + ca)
+    rot[:, 1, 2] = torch.squeeze(yzC - xs)
+    rot[:, 2, 0] = torch.squeeze(zxC - ys)
+    rot[:, 2, 1] = torch.squeeze(yzC + xs)
+    rot[:, 2, 2] = torch.squeeze(z * zC + ca)
+    rot[:, 3, 3] = 1
+
+    return rot
+
+
+def reference_translation_matrix(translation_vector):
+    T = torch.zeros(translation_vector.shape[0], 4, 4, dtype=translation_vector.dtype)
+
+    t = translation_vector.contiguous().view(-1, 3, 1)
+
+    T[:, 0, 0] = 1
+    T[:, 1, 1] = 1
+    T[:, 2, 2] = 1
+    T[:, 3, 3] = 1
+    T[:, :3, 3, None] = t
+
+    return T
+
+
+def reference_transformation(axisangle, translation, invert=False):
+    """The matrix product composition that `transformation_from_parameters` replaces
+    """
+    R = reference_rot_from_axisangle(axisangle)
+    t = translation.clone()
+
+    if invert:
+        R = R.transpose(1, 2)
+        t *= -1
+
+    T = reference_translation_matrix(t)
+
+    if invert:
+        return torch.matmul(R, T)
+    return torch.matmul(T, R)
+
+
+def pose_inputs(batch_size=5, dtype=torch.float64):
+    generator = torch.Generator().manual_seed(0)
+    axisangle = torch.randn(batch_size, 1, 3, generator=generator, dtype=dtype)
+    translation = torch.randn(batch_size, 1, 3, generator=generator, dtype=dtype)
+    return axisangle, translation
+
+
+def test_rot3_from_axisangle_matches_reference():
+    axisangle, _ = pose_inputs()
+    torch.testing.assert_close(
+        rot3_from_axisangle(axisangle), reference_rot_from_axisangle(axisangle)[:, :3, :3])
+
+
+@pytest.mark.parametrize("invert", [False, True])
+def test_transformation_matches_reference(invert):
+    axisangle, translation = pose_inputs()
+    torch.testing.assert_close(
+        transformation_from_parameters(axisangle, translation, invert),
+        reference_transformation(axisangle, translation, invert))
+
+
+def test_transformation_per_sample_invert():
+    axisangle, translation = pose_inputs()
+    invert = torch.tensor([True, False, False, True, True])
+    expected = torch.stack([
+        reference_transformation(axisangle[i:i + 1], translation[i:i + 1], bool(inv))[0]
+        for i, inv in enumerate(invert)])
+    torch.testing.assert_close(
+        transformation_from_parameters(axisangle, translation, invert), expected)
+
+
+@pytest.mark.parametrize("invert", [False, True])
+def test_transformation_zero_rotation(invert):
+    _, translation = pose_inputs()
+    axisangle = torch.zeros_like(translation)
+    M = transformation_from_parameters(axisangle, translation, invert)
+
+    sign = -1 if invert else 1
+    torch.testing.assert_close(M[:, :3, :3], torch.eye(3, dtype=M.dtype).expand(5, 3, 3))
+    torch.testing.assert_close(M[:, :3, 3], sign * translation[:, 0])
+    torch.testing.assert_close(
+        M, reference_transformation(axisangle, translation, invert))
+
+    axisangle.requires_grad_()
+    grad, = torch.autograd.grad(
+        transformation_from_parameters(axisangle, translation, invert).sum(), axisangle)
+    ref_grad, = torch.autograd.grad(
+        reference_transformation(axisangle, translation, invert).sum(), axisangle)
+    assert torch.isfinite(grad).all()
+    torch.testing.assert_close(grad, ref_grad)
+
+
+@pytest.mark.parametrize("invert", [False, True, torch.tensor([True, False, True, False, True])])
+def test_transformation_gradients(invert):
+    axisangle, translation = pose_inputs()
+    axisangle.requires_grad_()
+    translation.requires_grad_()
+    weights = torch.randn(5, 4, 4, generator=torch.Generator().manual_seed(1), dtype=torch.float64)
+
+    loss = (transformation_from_parameters(axisangle, translation, invert) * weights).sum()
+    grads = torch.autograd.grad(loss, (axisangle, translation))
+    if torch.is_tensor(invert):
+        ref = torch.cat([
+            reference_transformation(axisangle[i:i + 1], translation[i:i + 1], bool(inv))
+            for i, inv in enumerate(invert)])
+    else:
+        ref = reference_transformation(axisangle, translation, invert)
+    ref_grads = torch.autograd.grad((ref * weights).sum(), (axisangle, translation))
+
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad)
+    assert torch.autograd.gradcheck(
+        lambda a, t: transformation_from_parameters(a, t, invert), (axisangle, translation))
+
+
+def reference_smooth_loss(disp, img, normalize=False):
+    """The autograd smoothness loss that `SmoothLoss` replaces
+    """
+    if normalize:
+        disp = disp / (disp.mean(2, True).mean(3, True) + 1e-7)
+
+    grad_disp_x = torch.abs(disp[:, :, :, :-1] - disp[:, :, :, 1:])
+    grad_disp_y = torch.abs(disp[:, :, :-1, :] - disp[:, :, 1:, :])
+
+    grad_img_x = torch.mean(torch.abs(img[:, :, :, :-1] - img[:, :, :, 1:]), 1, keepdim=True)
+    grad_img_y = torch.mean(torch.abs(img[:, :, :-1, :] - img[:, :, 1:, :]), 1, keepdim=True)
+
+    grad_disp_x *= torch.exp(-grad_img_x)
+    grad_disp_y *= torch.exp(-grad_img_y)
+
+    return grad_disp_x.mean() + grad_disp_y.mean()
+
+
+def smooth_inputs(dtype=torch.float64, shape=(2, 1, 6, 7)):
+    generator = torch.Generator().manual_seed(0)
+    disp = (torch.rand(shape, generator=generator, dtype=dtype) + 0.1).requires_grad_()
+    img = torch.rand(shape[0], 3, shape[2], shape[3], generator=generator, dtype=dtype)
+    return disp, img
+
+
+@pytest.mark.parametrize("normalize", [True, False])
+def test_smooth_loss_gradcheck(normalize):
+    disp, img = smooth_inputs()
+    assert torch.autograd.gradcheck(
+        lambda d: get_smooth_loss(d, img, normalize=normalize), (disp,))
+
+
+@pytest.mark.parametrize("normalize", [True, False])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+def test_smooth_loss_matches_reference(normalize, dtype):
+    disp, img = smooth_inputs(dtype, shape=(4, 1, 24, 32))
+
+    loss = get_smooth_loss(disp, img, normalize=normalize)
+    grad, = torch.autograd.grad(loss, disp)
+    ref_loss = reference_smooth_loss(disp, img, normalize=normalize)
+    ref_grad, = torch.autograd.grad(ref_loss, disp)
+
+    assert loss.dtype == dtype
+    torch.testing.assert_close(loss, ref_loss)
+    torch.testing.assert_close(grad, ref_grad)
+
+
+def test_smooth_loss_image_gradients():
+    disp, img = smooth_inputs()
+    img.requires_grad_()
+    assert torch.autograd.gradcheck(
+        lambda d, i: get_smooth_loss(d, i, normalize=True), (disp, img))
+
+
+class ReferenceSSIM(nn.Module):
+    """The SSIM layer with one average pooling per moment that `SSIM` replaces
+    """
+    def __init__(self):
+        super(ReferenceSSIM, self).__init__()
+        self.pool = nn.AvgPool2d(3, 1)
+        self.refl = nn.ReflectionPad2d(1)
+
+        self.C1 = 0.01 ** 2
+        self.C2 = 0.03 ** 2
+
+    def forward(self, x, y):
+        x = self.refl(x)
+        y = self.refl(y)
+
+        mu_x = self.pool(x)
+        mu_y = self.pool(y)
+
+        sigma_x = self.pool(x ** 2) - mu_x ** 2
+        sigma_y = self.pool(y ** 2) - mu_y ** 2
+        sigma_xy = self.pool(x * y) - mu_x * mu_y
+
+        SSIM_n = (2 * mu_x * mu_y + self.C1) * (2 * sigma_xy + self.C2)
+        SSIM_d = (mu_x ** 2 + mu_y ** 2 + self.C1) * (sigma_x + sigma_y + self.C2)
+
+        return torch.clamp((1 - SSIM_n / SSIM_d) / 2, 0, 1)
+
+
+def ssim_inputs(dtype=torch.float64, shape=(2, 3, 12, 16)):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(shape, generator=generator, dtype=dtype).requires_grad_()
+    y = torch.rand(shape, generator=generator, dtype=dtype).requires_grad_()
+    return x, y
+
+
+def saved_tensor_bytes(fn, *args):
+    """Total size of the distinct storages autograd keeps for the backward of `fn`
+    """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn(*args)
+    return sum(storages.values())
+
+
+def test_ssim_matches_reference():
+    x, y = ssim_inputs()
+    weights = torch.rand(x.shape, generator=torch.Generator().manual_seed(1), dtype=x.dtype)
+
+    loss = SSIM()(x, y)
+    grads = torch.autograd.grad((loss * weights).sum(), (x, y))
+    ref_loss = ReferenceSSIM()(x, y)
+    ref_grads = torch.autograd.grad((ref_loss * weights).sum(), (x, y))
+
+    torch.testing.assert_close(loss, ref_loss)
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad)
+
+
+def test_ssim_gradcheck():
+    x, y = ssim_inputs(shape=(1, 2, 5, 6))
+    assert torch.autograd.gradcheck(SSIM(), (x, y))
+
+
+def test_ssim_saved_tensors():
+    x, y = ssim_inputs(torch.float32, shape=(2, 3, 48, 64))
+    # the two pooled products are not kept by BoxFilter
+    padded_bytes = x.shape[0] * x.shape[1] * (x.shape[2] + 2) * (x.shape[3] + 2) * 4
+    assert saved_tensor_bytes(SSIM(), x, y) \
+        <= saved_tensor_bytes(ReferenceSSIM(), x, y) - 2 * padded_bytes
+
+
+def test_box_filter_gradcheck():
+    x = torch.rand(2, 3, 6, 7, generator=torch.Generator().manual_seed(0), dtype=torch.float64)
+    assert torch.autograd.gradcheck(BoxFilter.apply, (x.requires_grad_(),))
+
+
+def test_photometric_loss_matches_reference():
+    x, y = ssim_inputs()
+    loss = SSIM().photometric_loss(x, y)
+    grads = torch.autograd.grad(loss.sum(), (x, y))
+
+    ref_loss = 0.85 * ReferenceSSIM()(x, y).mean(1, True) + 0.15 * torch.abs(y - x).mean(1, True)
+    ref_grads = torch.autograd.grad(ref_loss.sum(), (x, y))
+
+    assert loss.shape == (x.shape[0], 1) + x.shape[2:]
+    torch.testing.assert_close(loss, ref_loss)
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad)
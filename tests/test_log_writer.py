@@ -0,0 +1,54 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+from log_writer import LogWriter
+
+
+def test_calls_run_in_order_off_the_calling_thread():
+    writer = LogWriter()
+    calls, threads = [], []
+
+    def log(value, scale=1):
+        calls.append(value * scale)
+        threads.append(threading.current_thread())
+
+    for value in range(5):
+        writer.submit(log, value, scale=2)
+    writer.flush()
+    assert calls == [0, 2, 4, 6, 8]
+    assert threading.current_thread() not in threads
+    writer.close()
+    assert not writer.thread.is_alive()
+
+
+def test_failed_call_is_printed_and_later_calls_still_run(capsys):
+    writer = LogWriter()
+    calls = []
+
+    def fail():
+        raise ValueError("no connection")
+
+    writer.submit(fail)
+    writer.submit(calls.append, 1)
+    writer.close()
+    assert calls == [1]
+    assert "Logging failed: ValueError('no connection')" in capsys.readouterr().out
+
+
+def test_full_queue_blocks_submit():
+    writer = LogWriter(max_queue_size=1)
+    release = threading.Event()
+    writer.submit(release.wait)
+    # the thread is blocked in the first call, the second one fills the queue
+    writer.submit(lambda: None)
+
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (writer.submit(lambda: None), submitted.set()))
+    thread.start()
+    assert not submitted.wait(0.2)
+
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+    writer.close()
@@ -0,0 +1,37 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+
+from metrics_sink import JSONLSink, MetricsSink, NullSink, make_metrics_sink
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_metrics_sink_is_abstract():
+    with pytest.raises(TypeError):
+        MetricsSink()
+    NullSink().log({"loss": 1.0}, 0)
+
+
+def test_jsonl_sink_buffers_records(tmp_path):
+    sink = JSONLSink(str(tmp_path), flush_every=2)
+    sink.log({"loss": 1.0}, 0)
+    assert not (tmp_path / "metrics.jsonl").exists()
+
+    sink.log({"loss": 0.5}, 1)
+    sink.log({"loss": 0.25}, 2)
+    assert [r["step"] for r in read_records(tmp_path / "metrics.jsonl")] == [0, 1]
+
+    sink.close()
+    records = read_records(tmp_path / "metrics.jsonl")
+    assert [(r["step"], r["loss"]) for r in records] == [(0, 1.0), (1, 0.5), (2, 0.25)]
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        make_metrics_sink("csv", str(tmp_path), "model")
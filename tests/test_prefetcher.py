@@ -0,0 +1,81 @@
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import threading
+
+import pytest
+import torch
+
+from datasets import DataPrefetcher
+
+
+class Loader:
+    """Batches {"x": [i]} for i < num_batches, raising `error` instead of batch `fail_at`
+    """
+    def __init__(self, num_batches, fail_at=None, error=None):
+        self.num_batches = num_batches
+        self.fail_at = fail_at
+        self.error = error
+        self.loaded = 0
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for i in range(self.num_batches):
+            if i == self.fail_at:
+                raise self.error
+            self.loaded += 1
+            yield {"x": torch.tensor([i])}
+
+
+def test_thread_yields_every_batch_in_order():
+    prefetcher = DataPrefetcher(Loader(5), torch.device("cpu"))
+    assert len(prefetcher) == 5
+    for epoch in range(2):
+        batches = [inputs["x"].item() for inputs in prefetcher]
+        assert batches == list(range(5))
+        assert prefetcher.wait_time >= prefetcher.last_wait >= 0
+
+
+def test_thread_stops_when_iteration_is_abandoned():
+    loader = Loader(10 ** 6)
+    prefetcher = DataPrefetcher(loader, torch.device("cpu"), num_buffers=2)
+    num_threads = threading.active_count()
+    batches = iter(prefetcher)
+    assert [inputs["x"].item() for inputs in itertools.islice(batches, 3)] == [0, 1, 2]
+    assert threading.active_count() == num_threads + 1
+
+    batches.close()
+    assert threading.active_count() == num_threads
+    # ahead of the consumed batches, at most the buffered ones, the one being put and
+    # the one loaded before the stop is seen
+    assert loader.loaded <= 3 + 2 + 2
+
+
+def test_loader_error_is_raised_after_previous_batches():
+    prefetcher = DataPrefetcher(Loader(5, fail_at=3, error=IOError("broken image")),
+                                torch.device("cpu"))
+    batches = []
+    with pytest.raises(IOError, match="broken image"):
+        for inputs in prefetcher:
+            batches.append(inputs["x"].item())
+    assert batches == [0, 1, 2]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_cuda_copies_on_side_stream():
+    device = torch.device("cuda")
+    prefetcher = DataPrefetcher(Loader(4), device)
+    batches = []
+    for inputs in prefetcher:
+        assert inputs["x"].device.type == "cuda"
+        batches.append(inputs["x"].item())
+    assert batches == list(range(4))
+
+    prefetcher = DataPrefetcher(Loader(4, fail_at=2, error=IOError("broken image")), device)
+    batches = []
+    with pytest.raises(IOError, match="broken image"):
+        for inputs in prefetcher:
+            batches.append(inputs["x"].item())
+    assert batches == [0]
@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from datasets import ResumableRandomSampler, TemporalLocalitySampler
+from datasets.split_index import SplitIndex
+
+
+class Split:
+    """The `index` and length a sampler reads from a dataset
+    """
+    def __init__(self, filenames):
+        self.index = SplitIndex(filenames)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def split(num_folders=3, frames_per_folder=13):
+    # shuffled lines, the sampler sorts them by folder, side and frame index
+    filenames = ["folder_{} {} {}".format(folder, frame_index, side)
+                 for frame_index in range(frames_per_folder)
+                 for side in "rl"
+                 for folder in range(num_folders)]
+    return Split(filenames)
+
+
+def test_same_epoch_same_order():
+    sampler = ResumableRandomSampler(range(20), seed=5)
+    sampler.set_epoch(2)
+    order = list(sampler)
+    assert sorted(order) == list(range(20))
+
+    other = ResumableRandomSampler(range(20), seed=5)
+    other.set_epoch(2)
+    assert list(other) == order
+    assert list(sampler) == order
+
+
+def test_set_epoch_reshuffles():
+    sampler = ResumableRandomSampler(range(20), seed=5)
+    orders = []
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        orders.append(list(sampler))
+    assert orders[0] != orders[1] != orders[2]
+    assert all(sorted(order) == list(range(20)) for order in orders)
+
+
+def test_set_start_skips_only_the_next_epoch():
+    sampler = ResumableRandomSampler(range(20), seed=5)
+    sampler.set_epoch(1)
+    order = list(sampler)
+
+    sampler.set_start(8)
+    assert len(sampler) == 12
+    assert list(sampler) == order[8:]
+    # the start only applies to the epoch it was set for
+    assert len(sampler) == 20
+    assert list(sampler) == order
+
+
+def test_replicas_shard_padded_order():
+    samplers = [ResumableRandomSampler(range(10), seed=5, num_replicas=3, rank=rank)
+                for rank in range(3)]
+    orders = [list(sampler) for sampler in samplers]
+    assert [len(order) for order in orders] == [4, 4, 4]
+    # 12 slots for 10 indices, the first 2 shuffled indices are repeated at the end
+    assert sorted(sum(orders, [])) == sorted(list(range(10)) + [orders[0][0], orders[1][0]])
+
+    samplers[1].set_start(3)
+    assert list(samplers[1]) == orders[1][3:]
+
+
+@pytest.mark.parametrize("batch_size, num_workers, run_length",
+                         [(2, 2, 4), (3, 1, 5), (4, 0, 7), (1, 3, 1), (5, 2, 30)])
+def test_temporal_every_index_once_per_epoch(batch_size, num_workers, run_length):
+    data = split()
+    sampler = TemporalLocalitySampler(data, batch_size, num_workers, run_length, seed=5)
+    orders = []
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        orders.append(list(sampler))
+        assert len(orders[-1]) == len(sampler) == len(data)
+        assert sorted(orders[-1]) == list(range(len(data)))
+    assert orders[0] != orders[1]
+
+    sampler.set_epoch(1)
+    sampler.set_start(10)
+    assert list(sampler) == orders[1][10:]
+
+
+def test_temporal_replicas_cover_every_index():
+    data = split()
+    orders = [list(TemporalLocalitySampler(data, 2, 2, 4, seed=5, num_replicas=4, rank=rank))
+              for rank in range(4)]
+    assert [len(order) for order in orders] == [20, 20, 20, 20]
+    assert set(sum(orders, [])) == set(range(len(data)))
+
+
+def test_temporal_worker_batches_follow_runs():
+    # runs of 4 frames do not cross a folder or side
+    data = split(frames_per_folder=12)
+    batch_size, num_workers, run_length = 2, 2, 4
+    order = list(TemporalLocalitySampler(data, batch_size, num_workers, run_length, seed=5))
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    # the first block of 4 runs: worker 0 gets batches 0, 2, 4, 6, made of the frames of
+    # 2 of the runs
+    worker_batches = batches[:run_length * num_workers:num_workers]
+    for slot in range(batch_size):
+        run = [data.index[batch[slot]] for batch in worker_batches]
+        folder, frame_index, side = run[0]
+        assert run == [(folder, frame_index + t, side) for t in range(run_length)]
@@ -0,0 +1,35 @@
+from __future__ import absolute_import, division, print_function
+
+from datasets.split_index import SplitIndex
+
+
+def test_lines_round_trip():
+    filenames = ["2011_09_26/2011_09_26_drive_0001_sync 12 l",
+                 "2011_09_26/2011_09_26_drive_0001_sync 13 r",
+                 "2011_09_28/2011_09_28_drive_0002_sync 1234567890 l",
+                 "2011_09_26/2011_09_26_drive_0001_sync 14 l"]
+    index = SplitIndex(filenames)
+
+    assert len(index) == 4
+    assert [index[i] for i in range(len(index))] == [
+        ("2011_09_26/2011_09_26_drive_0001_sync", 12, "l"),
+        ("2011_09_26/2011_09_26_drive_0001_sync", 13, "r"),
+        ("2011_09_28/2011_09_28_drive_0002_sync", 1234567890, "l"),
+        ("2011_09_26/2011_09_26_drive_0001_sync", 14, "l")]
+    # the folders are stored once, in order of appearance
+    assert index.folders == ("2011_09_26/2011_09_26_drive_0001_sync",
+                             "2011_09_28/2011_09_28_drive_0002_sync")
+    assert index.entries["folder"].tolist() == [0, 0, 1, 0]
+
+
+def test_folder_only_lines():
+    index = SplitIndex(["scene_a", "scene_b 3 l"])
+    assert index[0] == ("scene_a", 0, None)
+    assert index[1] == ("scene_b", 3, "l")
+    assert index[-1] == index[1]
+
+
+def test_empty_split():
+    index = SplitIndex([])
+    assert len(index) == 0
+    assert index.folders == ()
@@ -0,0 +1,70 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+
+from step_timer import StepTimer
+
+
+class ScalarWriter:
+    def __init__(self):
+        self.scalars = {}
+
+    def add_scalar(self, tag, value, step):
+        self.scalars[tag] = (value, step)
+
+
+def test_disabled_records_nothing():
+    timer = StepTimer()
+    with timer("forward"):
+        pass
+    timer.add("data", 1.0)
+    assert timer("forward") is timer("backward")
+    assert timer.step() is None
+    assert not timer.durations
+
+
+def test_summary_every_frequency_steps():
+    timer = StepTimer(frequency=2)
+    timer.add("data", 0.001)
+    with timer("forward"):
+        pass
+    assert timer.step() is None
+
+    timer.add("data", 0.003)
+    summary = timer.step()
+    assert set(summary) == {"data", "forward"}
+    assert summary["data"]["mean"] == pytest.approx(2.0)
+    # per step, over the 2 steps of the window
+    assert summary["data"]["total"] == pytest.approx(2.0)
+    assert summary["data"]["p50"] == pytest.approx(2.0)
+    assert summary["data"]["p99"] == pytest.approx(2.98)
+    assert summary["forward"]["total"] == pytest.approx(summary["forward"]["mean"] / 2)
+
+    # the next window starts empty
+    assert not timer.durations
+    timer.step()
+    assert timer.step() == {}
+
+
+def test_section_records_when_raising():
+    timer = StepTimer(frequency=1)
+    with pytest.raises(ValueError):
+        with timer("forward"):
+            raise ValueError
+    assert len(timer.durations["forward"]) == 1
+
+
+def test_write_to_writer_and_json(tmp_path):
+    path = tmp_path / "timing.jsonl"
+    timer = StepTimer(frequency=1, json_path=str(path))
+    writer = ScalarWriter()
+    for step in range(2):
+        timer.add("data", 0.001)
+        timer.write(timer.step(), step, writer)
+
+    assert writer.scalars["timing/data/mean"] == (pytest.approx(1.0), 1)
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["step"] for line in lines] == [0, 1]
+    assert lines[0]["timing_ms"]["data"]["p90"] == pytest.approx(1.0)
@@ -0,0 +1,507 @@
+from __future__ import absolute_import, division, print_function
+
+import copy
+import os
+from argparse import Namespace
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+import datasets
+import networks
+from layers import (SSIM, BackprojectDepth, Project3D, get_smooth_loss,
+                    transformation_from_parameters)
+from step_timer import StepTimer
+from trainer import Trainer
+
+
+def make_trainer(**opts):
+    """A Trainer with only the options and models the tested methods read
+    """
+    trainer = Trainer.__new__(Trainer)
+    trainer.opt = Namespace(**opts)
+    return trainer
+
+
+def test_predict_poses_shared():
+    num_ch_enc = [4, 8]
+    batch_size = 3
+    trainer = make_trainer(frame_ids=[0, -1, 1], pose_model_type="shared",
+                           disable_mask=True, batch_pose_encoder=False, batch_size=batch_size)
+    trainer.num_pose_frames = 2
+    trainer.models_pose = {"pose": networks.PoseDecoder(num_ch_enc, 2)}
+    torch.nn.init.normal_(trainer.models_pose["pose"].convs[("pose", 2)].weight)
+
+    generator = torch.Generator().manual_seed(0)
+    features = {f_i: [torch.randn(batch_size, c, 4, 4, generator=generator) for c in num_ch_enc]
+                for f_i in [0, -1, 1]}
+
+    with torch.no_grad():
+        outputs = trainer.predict_poses({}, features)
+
+        for f_i in [-1, 1]:
+            pair = [features[f_i], features[0]] if f_i < 0 else [features[0], features[f_i]]
+            axisangle, translation = trainer.models_pose["pose"](pair)
+            torch.testing.assert_close(outputs[("axisangle", 0, f_i)], axisangle)
+            torch.testing.assert_close(
+                outputs[("cam_T_cam", 0, f_i)],
+                transformation_from_parameters(axisangle[:, 0], translation[:, 0], f_i < 0))
+
+
+
+def loss_trainer(**opts):
+    options = dict(frame_ids=[0, -1, 1], scales=[0, 1, 2, 3], height=32, width=64,
+                   v1_multiscale=False, avg_reprojection=False, no_ssim=False,
+                   disable_automasking=False, predictive_mask=False,
+                   disable_ambiguity_mask=False, ambiguity_by_negative_exponential=False,
+                   ambiguity_thresh=1.0, negative_exponential_coefficient=3.0,
+                   disparity_smoothness=1e-3, disable_triplet_loss=True)
+    options.update(opts)
+    trainer = make_trainer(**options)
+    trainer.ssim = SSIM()
+    trainer.timer = StepTimer()
+    trainer.device = torch.device("cpu")
+    return trainer
+
+
+def loss_batch(opt, batch_size=2):
+    generator = torch.Generator().manual_seed(0)
+    num_sources = len(opt.frame_ids) - 1
+    inputs, outputs = {}, {}
+    for scale in opt.scales:
+        h, w = opt.height // 2 ** scale, opt.width // 2 ** scale
+        for f_i in opt.frame_ids:
+            inputs[("color", f_i, scale)] = torch.rand(batch_size, 3, h, w, generator=generator)
+        inputs[("raw_color", 0, scale)] = torch.rand(batch_size, 3, h, w, generator=generator)
+        outputs[("disp", scale)] = torch.rand(batch_size, 1, h, w, generator=generator)
+
+        if not opt.v1_multiscale:
+            h, w = opt.height, opt.width
+        outputs[("color_stacked", scale)] = torch.rand(
+            num_sources * batch_size, 3, h, w, generator=generator)
+        outputs[("sample_stacked", scale)] = torch.rand(
+            num_sources * batch_size, h, w, 2, generator=generator) * 2 - 1
+    return inputs, outputs
+
+
+def reference_losses(trainer, inputs, outputs):
+    """The per-scale losses and identity selections, recomputing the identity
+    reprojection losses and the ambiguities at every scale
+    """
+    opt = trainer.opt
+    num_sources = len(opt.frame_ids) - 1
+
+    def unstack(x):
+        return torch.cat(x.chunk(num_sources), 1)
+
+    losses, selections = {}, {}
+    for scale in opt.scales:
+        source_scale = scale if opt.v1_multiscale else 0
+        target = inputs[("color", 0, source_scale)].repeat(num_sources, 1, 1, 1)
+        sources = torch.cat([inputs[("color", f_i, source_scale)] for f_i in opt.frame_ids[1:]])
+
+        reprojection_loss = unstack(trainer.ssim.photometric_loss(
+            outputs[("color_stacked", scale)], target))
+        identity_reprojection_loss = unstack(trainer.ssim.photometric_loss(sources, target))
+        if opt.avg_reprojection:
+            reprojection_loss = reprojection_loss.mean(1, keepdim=True)
+            identity_reprojection_loss = identity_reprojection_loss.mean(1, keepdim=True)
+
+        _, min_idx = torch.min(reprojection_loss, dim=1)
+        target_ambiguity = Trainer.extract_ambiguity(inputs[("color", 0, source_scale)])
+        reproj_ambiguity = torch.gather(unstack(F.grid_sample(
+            Trainer.extract_ambiguity(sources), outputs[("sample_stacked", scale)],
+            padding_mode="border", align_corners=True)), 1, min_idx.unsqueeze(1))
+        synthetic_ambiguity, _ = torch.cat([target_ambiguity, reproj_ambiguity], 1).max(dim=1)
+        ambiguity_mask = synthetic_ambiguity < opt.ambiguity_thresh
+
+        identity_reprojection_loss += torch.randn(identity_reprojection_loss.shape) * 0.00001
+        combined = torch.cat((identity_reprojection_loss, reprojection_loss), dim=1)
+        to_optimise, idxs = torch.min(combined, dim=1)
+        selections[scale] = (idxs > identity_reprojection_loss.shape[1] - 1).float()
+
+        smooth_loss = get_smooth_loss(
+            outputs[("disp", scale)], inputs[("raw_color", 0, scale)], normalize=True)
+        losses[scale] = (to_optimise * ambiguity_mask).mean() \
+            + opt.disparity_smoothness * smooth_loss / (2 ** scale)
+    return losses, selections
+
+
+@pytest.mark.parametrize("v1_multiscale", [False, True])
+@pytest.mark.parametrize("avg_reprojection", [False, True])
+def test_cached_identity_losses_match_recomputation(v1_multiscale, avg_reprojection):
+    trainer = loss_trainer(v1_multiscale=v1_multiscale, avg_reprojection=avg_reprojection)
+    inputs, outputs = loss_batch(trainer.opt)
+
+    torch.manual_seed(0)
+    ref_losses, ref_selections = reference_losses(trainer, inputs, outputs)
+    torch.manual_seed(0)
+    losses = trainer.compute_losses(inputs, outputs)
+
+    for scale in trainer.opt.scales:
+        torch.testing.assert_close(losses["loss/{}".format(scale)], ref_losses[scale])
+        torch.testing.assert_close(
+            outputs["identity_selection/{}".format(scale)], ref_selections[scale])
+
+    # the noise is added out of place, the cached identity losses stay untouched
+    for source_scale in ({0} if not v1_multiscale else set(trainer.opt.scales)):
+        target = inputs[("color", 0, source_scale)].repeat(2, 1, 1, 1)
+        sources = torch.cat([inputs[("color", f_i, source_scale)] for f_i in [-1, 1]])
+        torch.testing.assert_close(
+            inputs[("identity_reprojection_losses", source_scale)],
+            torch.cat(trainer.ssim.photometric_loss(sources, target).chunk(2), 1))
+
+
+
+def sgt_trainer(**opts):
+    options = dict(height=64, width=128, sgt_scales=[3, 2, 1], sgt_kernel_size=[5, 5, 5],
+                   sgt_sparse=False, disable_hardest_neg=False, disable_isolated_triplet=False,
+                   sgt_margin=0.35, sgt_isolated_margin=0.65)
+    options.update(opts)
+    trainer = make_trainer(**options)
+    trainer.device = torch.device("cpu")
+    return trainer
+
+
+def sgt_batch(opt, batch_size=2, num_ch=8):
+    generator = torch.Generator().manual_seed(0)
+    labels = torch.randint(0, 4, (batch_size, 1, opt.height // 8, opt.width // 8),
+                           generator=generator).float()
+    inputs = {("seg", 0, 0): F.interpolate(labels, size=(opt.height, opt.width), mode="nearest")}
+    outputs = {("d_feature", s): torch.randn(
+        batch_size, num_ch, opt.height // 2 ** s, opt.width // 2 ** s,
+        generator=generator, dtype=torch.float64).requires_grad_() for s in opt.sgt_scales}
+    return inputs, outputs
+
+
+def reference_sgt_loss(opt, inputs, outputs):
+    """The triplet loss on fully unfolded k x k neighbourhoods, that the dense and sparse
+    computations replace
+    """
+    seg_target = inputs[('seg', 0, 0)]
+    total_loss = 0
+
+    for s, kernel_size in zip(opt.sgt_scales, opt.sgt_kernel_size):
+        pad = kernel_size // 2
+        h, w = opt.height // 2 ** s, opt.width // 2 ** s
+        seg = F.interpolate(seg_target, size=(h, w), mode='nearest')
+        seg_pad = F.pad(seg, pad=[pad] * 4, value=-1)
+        patches = seg_pad.unfold(2, kernel_size, 1).unfold(3, kernel_size, 1)
+        aggregated_label = patches - seg.unsqueeze(-1).unsqueeze(-1)
+        pos_idx = (aggregated_label == 0).float()
+        neg_idx = (aggregated_label != 0).float()
+        pos_num = pos_idx.sum(dim=(-1, -2))
+        neg_num = neg_idx.sum(dim=(-1, -2))
+
+        is_boundary = (pos_num >= kernel_size - 1) & (neg_num >= kernel_size - 1)
+
+        feature = F.normalize(outputs[('d_feature', s)], dim=1)
+        unfolded = F.pad(feature, [pad] * 4).unfold(2, kernel_size, 1).unfold(3, kernel_size, 1)
+        similarity = (feature.unsqueeze(-1).unsqueeze(-1) * unfolded).sum(dim=1, keepdim=True)
+        affinity = torch.clamp(2 - 2 * similarity, min=1e-9).sqrt()
+        neg_dist = neg_idx * affinity
+
+        if not opt.disable_hardest_neg:
+            neg_dist[neg_dist == 0] = 1e3
+            neg_dist = neg_dist.amin(dim=(-1, -2))[is_boundary]
+        else:
+            neg_dist = neg_dist.sum(dim=(-1, -2))[is_boundary] / neg_num[is_boundary]
+
+        pos_dist = ((pos_idx * affinity).sum(dim=(-1, -2)) / pos_num)[is_boundary]
+
+        zeros = torch.zeros(pos_dist.shape, dtype=pos_dist.dtype)
+        if not opt.disable_isolated_triplet:
+            loss = pos_dist + torch.max(zeros, opt.sgt_isolated_margin - neg_dist)
+        else:
+            loss = torch.max(zeros, opt.sgt_margin + pos_dist - neg_dist)
+        total_loss = total_loss + loss.mean() / (2 ** s)
+    return total_loss
+
+
+sgt_variants = [{}, {"disable_hardest_neg": True}, {"disable_isolated_triplet": True},
+                {"sgt_kernel_size": [7, 5, 3]}]
+
+
+def sgt_loss_and_grads(trainer):
+    inputs, outputs = sgt_batch(trainer.opt)
+    loss = trainer.compute_sgt_loss(inputs, outputs)
+    features = [outputs[("d_feature", s)] for s in trainer.opt.sgt_scales]
+    return loss, torch.autograd.grad(loss, features)
+
+
+@pytest.mark.parametrize("opts", sgt_variants)
+def test_dense_sgt_loss_matches_unfold(opts):
+    trainer = sgt_trainer(**opts)
+    loss, grads = sgt_loss_and_grads(trainer)
+
+    inputs, outputs = sgt_batch(trainer.opt)
+    ref_loss = reference_sgt_loss(trainer.opt, inputs, outputs)
+    ref_grads = torch.autograd.grad(
+        ref_loss, [outputs[("d_feature", s)] for s in trainer.opt.sgt_scales])
+
+    assert ref_loss > 0
+    torch.testing.assert_close(loss, ref_loss)
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad)
+
+
+@pytest.mark.parametrize("opts", sgt_variants)
+def test_sparse_sgt_loss_matches_dense(opts):
+    loss, grads = sgt_loss_and_grads(sgt_trainer(sgt_sparse=True, **opts))
+    dense_loss, dense_grads = sgt_loss_and_grads(sgt_trainer(**opts))
+
+    torch.testing.assert_close(loss, dense_loss)
+    for grad, dense_grad in zip(grads, dense_grads):
+        torch.testing.assert_close(grad, dense_grad)
+
+
+
+def batch_trainer():
+    """A trainer with every model `process_batch` runs, on lite-mono-tiny at its
+    smallest supported resolution
+    """
+    trainer = loss_trainer(scales=[0, 1, 2], height=192, width=640, batch_size=1,
+                           disable_auto_blur=True, disable_ambiguity_mask=True,
+                           pose_model_type="separate_resnet", disable_mask=True,
+                           batch_pose_encoder=False, min_depth=0.1, max_depth=100.0)
+    opt = trainer.opt
+    torch.manual_seed(0)
+    encoder = networks.LiteMono(model="lite-mono-tiny", height=opt.height, width=opt.width)
+    trainer.models = {"encoder": encoder,
+                      "depth": networks.DepthDecoder(encoder.num_ch_enc, opt.scales)}
+    pose_encoder = networks.ResnetEncoder(18, False, num_input_images=2)
+    trainer.models_pose = {"pose_encoder": pose_encoder,
+                           "pose": networks.PoseDecoder(pose_encoder.num_ch_enc, 1, 2)}
+    for model in list(trainer.models.values()) + list(trainer.models_pose.values()):
+        model.eval()
+    trainer.use_pose_net = True
+    trainer.num_pose_frames = 2
+    trainer.backproject_depth, trainer.project_3d = {}, {}
+    for scale in opt.scales:
+        h, w = opt.height // 2 ** scale, opt.width // 2 ** scale
+        trainer.backproject_depth[scale] = BackprojectDepth(opt.batch_size, h, w)
+        trainer.project_3d[scale] = Project3D(opt.batch_size, h, w)
+    return trainer
+
+
+def model_inputs(opt):
+    generator = torch.Generator().manual_seed(1)
+    inputs = {}
+    for scale in opt.scales:
+        h, w = opt.height // 2 ** scale, opt.width // 2 ** scale
+        for f_i in opt.frame_ids:
+            inputs[("color", f_i, scale)] = torch.rand(
+                opt.batch_size, 3, h, w, generator=generator)
+        K = torch.tensor([[0.58 * w, 0, 0.5 * w, 0], [0, 1.92 * h, 0.5 * h, 0],
+                          [0, 0, 1, 0], [0, 0, 0, 1]]).expand(opt.batch_size, 4, 4)
+        inputs[("K", scale)] = K
+        inputs[("inv_K", scale)] = torch.linalg.pinv(K)
+    for f_i in opt.frame_ids:
+        inputs[("color_aug", f_i, 0)] = inputs[("color", f_i, 0)]
+    return inputs
+
+
+def test_bf16_process_batch_losses_close_to_fp32():
+    trainer = batch_trainer()
+
+    torch.manual_seed(0)
+    with torch.no_grad():
+        _, losses = trainer.process_batch(model_inputs(trainer.opt))
+    torch.manual_seed(0)
+    with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        outputs, bf16_losses = trainer.process_batch(model_inputs(trainer.opt))
+
+    # the autocast regions really ran in bf16, the losses are computed in fp32
+    assert outputs[("disp", 0)].dtype == torch.bfloat16
+    for name in losses:
+        assert bf16_losses[name].dtype == torch.float32
+        torch.testing.assert_close(bf16_losses[name], losses[name], rtol=2e-2, atol=1e-3)
+
+
+
+class IndexDataset(torch.utils.data.Dataset):
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        return {"index": torch.tensor(index)}
+
+
+def epoch_trainer(save_step_frequency=0, num_samples=12, batch_size=2, load_weights_folder=None):
+    """A trainer whose run_epoch trains a linear model on the sample indices, recording
+    the indices it sees and the training state of every checkpoint it saves
+    """
+    trainer = make_trainer(batch_size=batch_size, log_frequency=1,
+                           save_step_frequency=save_step_frequency,
+                           load_weights_folder=load_weights_folder)
+    model = torch.nn.Linear(1, 1)
+    trainer.models = {"depth": model}
+    trainer.model_optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    trainer.model_lr_scheduler = torch.optim.lr_scheduler.StepLR(trainer.model_optimizer, 1)
+    trainer.scaler = torch.amp.GradScaler("cuda", enabled=False)
+    trainer.use_pose_net = False
+    trainer.profile = False
+    trainer.is_main = False
+    trainer.timer = StepTimer()
+    trainer.device = torch.device("cpu")
+    trainer.amp_dtype = None
+
+    dataset = IndexDataset(num_samples)
+    trainer.train_sampler = datasets.ResumableRandomSampler(dataset, seed=3)
+    loader = DataLoader(dataset, batch_size, sampler=trainer.train_sampler, drop_last=True)
+    trainer.train_prefetcher = datasets.DataPrefetcher(loader, torch.device("cpu"))
+    trainer.num_steps_per_epoch = num_samples // batch_size
+
+    trainer.epoch, trainer.step, trainer.batch_idx = 1, 0, 0
+    trainer.epoch_finished = False
+    trainer.best_models = {}
+    trainer.seen, trainer.checkpoints = [], []
+
+    def process_batch(inputs):
+        trainer.seen += inputs["index"].tolist()
+        return {}, {"loss": model(inputs["index"].float()[:, None]).mean()}
+
+    def save_model(checkpoint=False, metrics=None):
+        trainer.checkpoints.append(trainer.training_state())
+
+    trainer.process_batch = process_batch
+    trainer.save_model = save_model
+    return trainer
+
+
+def resumed_trainer(state, tmp_path):
+    torch.save(state, os.path.join(str(tmp_path), "trainer_state.pth"))
+    trainer = epoch_trainer(load_weights_folder=str(tmp_path))
+    trainer.load_training_state()
+    return trainer
+
+
+def test_resume_mid_epoch_continues_sample_order(tmp_path):
+    trainer = epoch_trainer(save_step_frequency=2)
+    trainer.run_epoch()
+    assert len(trainer.seen) == 12 and sorted(trainer.seen) == list(range(12))
+    assert [state["batch_idx"] for state in trainer.checkpoints] == [2, 4, 6]
+
+    resumed = resumed_trainer(trainer.checkpoints[0], tmp_path)
+    assert (resumed.epoch, resumed.batch_idx, resumed.step) == (1, 2, 2)
+    resumed.run_epoch()
+    assert resumed.seen == trainer.seen[4:]
+    # the schedulers already stepped for this epoch before the checkpoint
+    assert resumed.model_lr_scheduler.last_epoch == trainer.model_lr_scheduler.last_epoch
+
+
+def test_checkpoint_on_last_batch_resumes_into_same_epoch(tmp_path):
+    trainer = epoch_trainer(save_step_frequency=2)
+    trainer.run_epoch()
+    # all batches are trained on, but the epoch's evaluation has not run yet
+    state = trainer.checkpoints[-1]
+    assert (state["epoch"], state["batch_idx"]) == (1, 6)
+
+    resumed = resumed_trainer(state, tmp_path)
+    resumed.run_epoch()
+    assert resumed.seen == []
+    assert resumed.model_lr_scheduler.last_epoch == trainer.model_lr_scheduler.last_epoch
+
+    # once run_epoch returned, checkpoints resume into the next epoch
+    trainer.epoch_finished = True
+    state = trainer.training_state()
+    assert (state["epoch"], state["batch_idx"]) == (2, 0)
+
+
+
+class CountingProfiler:
+    def __init__(self):
+        self.step_num = 0
+        self.stopped = False
+
+    def step(self):
+        self.step_num += 1
+
+    def stop(self):
+        self.stopped = True
+
+
+def test_profiles_first_epoch_of_resumed_run(tmp_path):
+    trainer = epoch_trainer()
+    state = trainer.training_state()
+    state["epoch"] = 3
+    trainer = resumed_trainer(state, tmp_path)
+    trainer.opt.profile_steps = [1, 1, 2]
+    trainer.profile = True
+    profilers = []
+
+    def start_profiler():
+        profilers.append(CountingProfiler())
+        return profilers[-1]
+
+    trainer.start_profiler = start_profiler
+    for trainer.epoch in range(3, 5):
+        trainer.batch_idx = 0
+        trainer.run_epoch()
+
+    # only the first epoch of this process is profiled, until the window is recorded
+    assert len(profilers) == 1
+    assert profilers[0].stopped and profilers[0].step_num == 4
+    assert not trainer.profile
+
+
+def ddp_worker(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    try:
+        trainer = make_trainer(frame_ids=[0, -1, 1], pose_model_type="separate_resnet",
+                               disable_mask=True, batch_pose_encoder=False, batch_size=2)
+        trainer.device = torch.device("cpu")
+        trainer.num_pose_frames = 2
+        trainer.models = {}
+        trainer.models_pose = {
+            "pose_encoder": networks.ResnetEncoder(18, False, num_input_images=2)}
+        trainer.models_pose["pose"] = networks.PoseDecoder(
+            trainer.models_pose["pose_encoder"].num_ch_enc, num_input_features=1,
+            num_frames_to_predict_for=2)
+        reference = copy.deepcopy(trainer.models_pose)
+        trainer.wrap_ddp()
+
+        generator = torch.Generator().manual_seed(rank)
+        for step in range(3):
+            inputs = {("color_aug", f_i, 0): torch.rand(2, 3, 64, 64, generator=generator)
+                      for f_i in [0, -1, 1]}
+            outputs = trainer.predict_poses(inputs, None)
+            sum(outputs[("cam_T_cam", 0, f_i)].sum() for f_i in [-1, 1]).backward()
+
+            # the same step without DDP, with the gradients averaged by hand
+            ref_trainer = make_trainer(**vars(trainer.opt))
+            ref_trainer.num_pose_frames = 2
+            ref_trainer.models_pose = reference
+            ref_outputs = ref_trainer.predict_poses(inputs, None)
+            sum(ref_outputs[("cam_T_cam", 0, f_i)].sum() for f_i in [-1, 1]).backward()
+
+            for name in reference:
+                ddp_params = trainer.models_pose[name].module.parameters()
+                for param, ref_param in zip(ddp_params, reference[name].parameters()):
+                    if ref_param.grad is None:
+                        # unused, e.g. the resnet classifier
+                        assert param.grad is None or not param.grad.any()
+                        continue
+                    dist.all_reduce(ref_param.grad)
+                    ref_param.grad /= world_size
+                    torch.testing.assert_close(param.grad, ref_param.grad, rtol=1e-4, atol=1e-6)
+                    param.grad = None
+                    ref_param.grad = None
+    finally:
+        dist.destroy_process_group()
+
+
+def test_ddp_static_graph_pose_encoder_twice_per_step():
+    """Two gloo processes, with the pose encoder called once per source frame
+    """
+    mp.spawn(ddp_worker, args=(2, 29531), nprocs=2, join=True)
@@ -33,9 +33,11 @@ import torch
 import numpy as np
 # MY_FIX: Set Random Seed Fixed
 # =====================================
-def set_seed(seed):
+def set_seed(seed, rank=0):
     if seed is None:
         seed = 1
+    # DDP broadcasts the weights of rank 0, the offset only decorrelates the augmentations
+    seed += rank
     print("Random Seed: {}".format(seed))
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
@@ -45,9 +47,31 @@ def set_seed(seed):
     torch.backends.cudnn.benchmark = False
 # =====================================
 
+import torch.distributed as dist
+def init_distributed(opts):
+    """Join the process group when launched with torchrun, e.g.
+    torchrun --nnodes 2 --nproc_per_node 4 --rdzv_endpoint <host>:29500 train.py ...
+    Returns the rank of this process
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return 0
+    use_cuda = torch.cuda.is_available() and not opts.no_cuda
+    backend = opts.ddp_backend
+    if backend == "auto":
+        backend = "nccl" if use_cuda else "gloo"
+    if use_cuda:
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    dist.init_process_group(backend=backend)
+    return dist.get_rank()
+# =====================================
+
 if __name__ == "__main__":
     torch.cuda.empty_cache()
-    set_seed(opts.random_seed)
-    copy_code(opts)
+    rank = init_distributed(opts)
+    set_seed(opts.random_seed, rank)
+    if rank == 0:
+        copy_code(opts)
     trainer = Trainer(opts)
-    trainer.train()
\ No newline at end of file
+    trainer.train()
+    if dist.is_initialized():
+        dist.destroy_process_group()
\ No newline at end of file
@@ -1,7 +1,10 @@
 from __future__ import absolute_import, division, print_function
 
 
+import copy
+import random
 import time
+import torch.distributed as dist
 import torch.optim as optim
 from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
@@ -14,9 +17,11 @@ from layers import *
 
 import datasets
 import networks
-from linear_warmup_cosine_annealing_warm_restarts_weight_decay import ChainedScheduler
+from step_timer import StepTimer
+from log_writer import LogWriter
+from checkpoint_writer import CheckpointWriter
 
-import wandb
+from metrics_sink import make_metrics_sink, NullSink
 
 # torch.backends.cudnn.benchmark = True
 
@@ -42,8 +47,33 @@ class Trainer:
         self.parameters_to_train = []
         self.parameters_to_train_pose = []
 
-        self.device = torch.device("cpu" if self.opt.no_cuda else "cuda")
-        self.profile = self.opt.profile
+        # distributed data parallel, when launched with torchrun (see train.py)
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_main = self.rank == 0
+        if self.opt.no_cuda:
+            self.device = torch.device("cpu")
+        elif self.distributed:
+            self.device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        else:
+            self.device = torch.device("cuda")
+        # profiles the first epoch this process trains, which a resumed run starts at
+        # its checkpoint, cleared once the profiling window is recorded
+        self.profile = self.opt.profile and self.is_main
+        if self.profile:
+            assert self.opt.profile_steps[2] > 0, \
+                "'profile_steps' needs a positive number of active steps"
+        self.timer = StepTimer(self.opt.timing_frequency, sync=self.opt.timing_sync,
+                               json_path=os.path.join(self.log_path, "timing.jsonl"))
+
+        # mixed precision: fp16 needs loss scaling, bf16 (also on CPU) does not
+        assert not (self.opt.mixed_precision == "fp16" and self.device.type == "cpu"), \
+            "fp16 mixed precision needs CUDA, use bf16 on CPU"
+        self.amp_dtype = {"none": None,
+                          "fp16": torch.float16,
+                          "bf16": torch.bfloat16}[self.opt.mixed_precision]
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.opt.mixed_precision == "fp16")
 
         self.num_scales = len(self.opt.scales)
         self.frame_ids = len(self.opt.frame_ids)
@@ -58,7 +88,8 @@ class Trainer:
 
         self.models["encoder"] = networks.LiteMono(model=self.opt.model,
                                                    drop_path_rate=self.opt.drop_path,
-                                                   width=self.opt.width, height=self.opt.height)
+                                                   width=self.opt.width, height=self.opt.height,
+                                                   checkpoint_stages=self.opt.checkpoint_stages)
 
         self.models["encoder"].to(self.device)
         self.parameters_to_train += list(self.models["encoder"].parameters())
@@ -94,6 +125,14 @@ class Trainer:
             self.models_pose["pose"].to(self.device)
             self.parameters_to_train_pose += list(self.models_pose["pose"].parameters())
 
+        '''MY Masking'''
+        # MASK
+        # =====================================
+        if self.use_pose_net and not self.opt.disable_mask:
+            self.random_mask = networks.RandomMaskModule(
+                self.opt.mask_ratio, patch_size=self.opt.mask_patch_size, seed=self.opt.random_seed)
+        # =====================================
+
         if self.opt.predictive_mask:
             assert self.opt.disable_automasking, \
                 "When using predictive_mask, please disable automasking with --disable_automasking"
@@ -110,6 +149,8 @@ class Trainer:
         if self.use_pose_net:
             self.model_pose_optimizer = optim.AdamW(self.parameters_to_train_pose, self.opt.lr[3], weight_decay=self.opt.weight_decay)
 
+        # only imported when a Trainer is built, so that its methods can be used without it
+        from linear_warmup_cosine_annealing_warm_restarts_weight_decay import ChainedScheduler
         self.model_lr_scheduler = ChainedScheduler(
                             self.model_optimizer,
                             T_0=int(self.opt.lr[2]),
@@ -137,10 +178,39 @@ class Trainer:
         if self.opt.mypretrain is not None:
             self.load_pretrain()
 
+        if self.distributed:
+            self.wrap_ddp()
+
         print("Training model named:\n  ", self.opt.model_name)
         print("Models and tensorboard events files are saved to:\n  ", self.opt.log_dir)
         print("Training is using:\n  ", self.device)
 
+        '''
+            Frequency-Aware Self-Supervised Depth Estimation (WACV 2023)
+        '''
+        # AutoBlur
+        # =====================================
+        if not self.opt.disable_auto_blur:
+            assert self.opt.receptive_field_of_auto_blur % 2 == 1, \
+                'receptive_field_of_auto_blur should be an odd number'
+            self.auto_blur = networks.AutoBlurModule(
+                self.opt.receptive_field_of_auto_blur,
+                hf_pixel_thresh=self.opt.hf_pixel_thresh,
+                hf_area_percent_thresh=self.opt.hf_area_percent_thresh,
+                tile_size=self.opt.auto_blur_tile_size,
+            )
+            self.auto_blur.to(self.device)
+
+        img_ext = '.png' if self.opt.png else '.jpg'
+        auto_blur_cache = None
+        if not self.opt.disable_auto_blur and self.opt.auto_blur_cache is not None:
+            # blur (and cache) the training frames in the dataloader workers instead
+            auto_blur_cache = datasets.AutoBlurCache(
+                copy.deepcopy(self.auto_blur).cpu(), self.opt.auto_blur_cache,
+                self.opt.scales, self.opt.height, self.opt.width,
+                self.opt.data_path, img_ext)
+        # =====================================
+
         # data
         datasets_dict = {"kitti": datasets.KITTIRAWDataset,
                          "kitti_odom": datasets.KITTIOdomDataset}
@@ -150,49 +220,57 @@ class Trainer:
 
         train_filenames = readlines(fpath.format("train")) if self.opt.size == 'full' else readlines(fpath.format("train_" + self.opt.size))
         val_filenames = readlines(fpath.format("val"))
-        img_ext = '.png' if self.opt.png else '.jpg'
 
-        num_train_samples = len(train_filenames)
-        self.num_total_steps = num_train_samples // self.opt.batch_size * self.opt.num_epochs
+        # every rank trains on its own shard of the (padded) training set
+        num_train_samples = -(-len(train_filenames) // self.world_size)
+        self.num_steps_per_epoch = num_train_samples // self.opt.batch_size
+        self.num_total_steps = self.num_steps_per_epoch * self.opt.num_epochs
 
         train_dataset = self.dataset(
             self.opt.data_path, train_filenames, self.opt.height, self.opt.width,
-            self.opt.frame_ids, 4, is_train=True, img_ext=img_ext)
+            self.opt.frame_ids, 4, is_train=True, img_ext=img_ext,
+            auto_blur_cache=auto_blur_cache,
+            frame_cache_bytes=self.opt.frame_cache_mb * 2 ** 20)
+        pin_memory = self.device.type == "cuda"
+        # the shuffled order only depends on the seed and the epoch, for mid-epoch resume.
+        # It is the same on every rank, so the seed has the default of set_seed (train.py)
+        # but not its rank offset
+        sampler_seed = 1 if self.opt.random_seed is None else self.opt.random_seed
+        if self.opt.temporal_run_length > 0:
+            # temporally adjacent samples go to the same worker, for the frame cache
+            self.train_sampler = datasets.TemporalLocalitySampler(
+                train_dataset, self.opt.batch_size, self.opt.num_workers,
+                self.opt.temporal_run_length, seed=sampler_seed,
+                num_replicas=self.world_size, rank=self.rank)
+        else:
+            self.train_sampler = datasets.ResumableRandomSampler(
+                train_dataset, seed=sampler_seed,
+                num_replicas=self.world_size, rank=self.rank)
         self.train_loader = DataLoader(
-            train_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=False, drop_last=True)
+            train_dataset, self.opt.batch_size, sampler=self.train_sampler,
+            num_workers=self.opt.num_workers, pin_memory=pin_memory, drop_last=True)
+        # moves batch N+1 to the device while batch N trains
+        self.train_prefetcher = datasets.DataPrefetcher(self.train_loader, self.device)
         val_dataset = self.dataset(
             self.opt.data_path, val_filenames, self.opt.height, self.opt.width,
             self.opt.frame_ids, 4, is_train=False, img_ext=img_ext)
         self.val_loader = DataLoader(
             val_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=False, drop_last=True)
+            num_workers=self.opt.num_workers, pin_memory=pin_memory, drop_last=True)
         self.val_iter = iter(self.val_loader)
 
+        # logging, checkpointing and evaluation only run on the main rank
         self.writers = {}
-        for mode in ["train", "val"]:
-            self.writers[mode] = SummaryWriter(os.path.join(self.log_path, mode))
+        if self.is_main:
+            for mode in ["train", "val"]:
+                self.writers[mode] = SummaryWriter(os.path.join(self.log_path, mode))
+        # tensorboard and the metrics sink are written on a background thread
+        self.log_writer = LogWriter()
 
         if not self.opt.no_ssim:
             self.ssim = SSIM()
             self.ssim.to(self.device)
             
-        '''
-            Frequency-Aware Self-Supervised Depth Estimation (WACV 2023)
-        '''
-        # AutoBlur
-        # =====================================
-        if not self.opt.disable_auto_blur:
-            assert self.opt.receptive_field_of_auto_blur % 2 == 1, \
-                'receptive_field_of_auto_blur should be an odd number'
-            self.auto_blur = networks.AutoBlurModule(
-                self.opt.receptive_field_of_auto_blur,
-                hf_pixel_thresh=self.opt.hf_pixel_thresh,
-                hf_area_percent_thresh=self.opt.hf_area_percent_thresh,
-            )
-            self.auto_blur.to(self.device)
-        # =====================================
-
         self.backproject_depth = {}
         self.project_3d = {}
         for scale in self.opt.scales:
@@ -212,14 +290,41 @@ class Trainer:
         print("There are {:d} training items and {:d} validation items\n".format(
             len(train_dataset), len(val_dataset)))
 
-        self.save_opts()
+        if self.is_main:
+            self.save_opts()
+            self.checkpoint_writer = CheckpointWriter(os.path.join(self.log_path, "models"))
         
         # MY_FIX: Set wandb
         # =====================================
-        self.wandb = wandb.init(project = "Lite-Mono",
-                    name = self.opt.model_name)
+        # run level metrics go to wandb, tensorboard or a local jsonl file
+        if self.is_main:
+            self.metrics = make_metrics_sink(
+                self.opt.metrics_backend, self.log_path, self.opt.model_name)
+        else:
+            self.metrics = NullSink()
         # =====================================
 
+    def wrap_ddp(self):
+        """Wrap every trained model in DistributedDataParallel, with synchronized
+        BatchNorm on CUDA. The optimizers keep working on the same parameters.
+        """
+        device_ids = [self.device.index] if self.device.type == "cuda" else None
+        for models in (self.models, self.models_pose):
+            for name, model in models.items():
+                if self.device.type == "cuda":
+                    # SyncBatchNorm has no CPU implementation
+                    model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+                # static_graph: the pose encoder may run twice per step, and LiteMono
+                # stages may be checkpointed
+                models[name] = nn.parallel.DistributedDataParallel(
+                    model, device_ids=device_ids, broadcast_buffers=False, static_graph=True)
+
+    @staticmethod
+    def unwrap(model):
+        """The model inside a DistributedDataParallel wrapper
+        """
+        return model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+
     def set_train(self):
         """Convert all models to training mode
         """
@@ -256,11 +361,16 @@ class Trainer:
         """
         self.epoch = 0
         self.step = 0
+        # number of batches of the current epoch already trained on
+        self.batch_idx = 0
+        # whether run_epoch returned for self.epoch, whose batches may all be trained on
+        # before that, when a checkpoint is saved on its last batch
+        self.epoch_finished = False
         self.start_time = time.time()
         # MY_FIX: Wandb Watch Depth models & Pose models
         # =====================================
-        self.wandb.watch(self.models['encoder'])
-        self.wandb.watch(self.models_pose['pose_encoder'])
+        self.metrics.watch(self.unwrap(self.models['encoder']))
+        self.metrics.watch(self.unwrap(self.models_pose['pose_encoder']))
         # MY_FIX: Best metrics initialization
         self.best_models = {
             'de/abs_rel': 1.0,
@@ -269,15 +379,23 @@ class Trainer:
             'de/log_rms': 1.0
         }
         # =====================================
-        for self.epoch in range(self.opt.num_epochs):
+        if self.opt.resume:
+            self.load_training_state()
+        for self.epoch in range(self.epoch, self.opt.num_epochs):
+            if self.epoch_finished:
+                self.batch_idx = 0
+                self.epoch_finished = False
             self.run_epoch()
+            # a checkpoint saved from here on resumes into the next epoch, one saved
+            # within run_epoch resumes into the rest of this one and its evaluation
+            self.epoch_finished = True
             # MY_FIX: Wandb Log Epoch & LR
             # =====================================
-            self.wandb.log({
+            self.log_writer.submit(self.metrics.log, {
                 'Epoch': (self.epoch + 1),
                 'Depth_LR': self.model_optimizer.state_dict()['param_groups'][0]['lr'],
                 'Pose_LR': self.model_pose_optimizer.state_dict()['param_groups'][0]['lr']
-            })
+            }, self.step)
             # =====================================
             '''ORIGINAL'''
             # ORIGINAL
@@ -286,27 +404,40 @@ class Trainer:
 
             # MY_FIX: Saving best model if get a better one
             # =====================================
-            metrics = self.evaluate()
-            if self.save_best(metrics):
-                self.wandb.log({
-                    'best/abs_rel': metrics['de/abs_rel'],
-                    'best/sq_rel': metrics['de/sq_rel'],
-                    'best/rms': metrics['de/rms'],
-                    'best/log_rms': metrics['de/log_rms']
-                })
-                self.save_model()
+            metrics = None
+            if self.is_main:
+                with self.timer("evaluate"):
+                    metrics = self.evaluate()
+                if self.save_best(metrics):
+                    self.log_writer.submit(self.metrics.log, {
+                        'best/abs_rel': metrics['de/abs_rel'],
+                        'best/sq_rel': metrics['de/sq_rel'],
+                        'best/rms': metrics['de/rms'],
+                        'best/log_rms': metrics['de/log_rms']
+                    }, self.step)
+                    self.save_model(metrics=metrics)
+            if self.distributed:
+                # the other ranks wait for the evaluation of the main rank
+                dist.barrier()
             # =====================================
+            if (self.epoch + 1) % self.opt.save_frequency == 0:
+                self.save_model(checkpoint=True, metrics=metrics)
         # MY_FIX
         # =====================================
         # Save Checkpoint
-        self.save_model(checkpoint=True)
+        if self.opt.num_epochs % self.opt.save_frequency != 0:
+            self.save_model(checkpoint=True)
         # Log Best Score as one
         error_metrics = ['abs_rel', 'sq_rel', 'rms', 'log_rms']
         for idx, v in enumerate(self.best_models.values()):
-            self.wandb.log({
+            self.log_writer.submit(self.metrics.log, {
                 error_metrics[idx]: v
-            })
+            }, self.step)
         # =====================================
+        self.log_writer.submit(self.metrics.close)
+        self.log_writer.close()
+        if self.is_main:
+            self.checkpoint_writer.close()
 
     def run_epoch(self):
         """Run a single epoch of training and validation
@@ -315,23 +446,37 @@ class Trainer:
         print("Training")
         self.set_train()
 
-        self.model_lr_scheduler.step()
-        if self.use_pose_net:
-            self.model_pose_lr_scheduler.step()
+        if self.batch_idx == 0:
+            # resuming mid-epoch, the schedulers already stepped for this epoch
+            self.model_lr_scheduler.step()
+            if self.use_pose_net:
+                self.model_pose_lr_scheduler.step()
 
-        for batch_idx, inputs in enumerate(self.train_loader):
+        # skip the batches consumed before a mid-epoch resume without loading them
+        self.train_sampler.set_epoch(self.epoch)
+        self.train_sampler.set_start(self.batch_idx * self.opt.batch_size)
+
+        profiler = self.start_profiler() if self.profile else None
+
+        for batch_idx, inputs in enumerate(self.train_prefetcher, self.batch_idx):
+            self.timer.add("data", self.train_prefetcher.last_wait)
             self.model_optimizer.zero_grad()
             if self.use_pose_net:
                 self.model_pose_optimizer.zero_grad()
                 
             before_op_time = time.time()
             
-            outputs, losses = self.process_batch(inputs)
-            losses["loss"].backward()
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype,
+                                enabled=self.amp_dtype is not None):
+                outputs, losses = self.process_batch(inputs)
+            with self.timer("backward"):
+                self.scaler.scale(losses["loss"]).backward()
             
-            self.model_optimizer.step()
-            if self.use_pose_net:
-                self.model_pose_optimizer.step()
+            with self.timer("optimizer"):
+                self.scaler.step(self.model_optimizer)
+                if self.use_pose_net:
+                    self.scaler.step(self.model_pose_optimizer)
+                self.scaler.update()
                 
             duration = time.time() - before_op_time
 
@@ -339,27 +484,106 @@ class Trainer:
             early_phase = batch_idx % self.opt.log_frequency == 0 and self.step < 20000
             late_phase = self.step % 2000 == 0
 
-            if early_phase or late_phase:
-                self.log_time(batch_idx, duration, losses["loss"].cpu().data)
-                # MY_FIX: Wandb Log Loss
-                # =====================================
-                self.wandb.log({
-                    'Total_loss': losses['loss'],
-                    'Step': self.step
-                })
-                # =====================================
-
-                if "depth_gt" in inputs:
-                    self.compute_depth_losses(inputs, outputs, losses)
-
-                self.log("train", inputs, outputs, losses)
+            if (early_phase or late_phase) and self.is_main:
+                with self.timer("logging"):
+                    loss = losses["loss"].item()
+                    self.log_time(batch_idx, duration, loss)
+                    # MY_FIX: Wandb Log Loss
+                    # =====================================
+                    self.log_writer.submit(self.metrics.log, {
+                        'Total_loss': loss,
+                        'Data_wait': self.train_prefetcher.last_wait,
+                        'Step': self.step
+                    }, self.step)
+                    # =====================================
+
+                    if "depth_gt" in inputs:
+                        self.compute_depth_losses(inputs, outputs, losses)
+
+                    self.log("train", inputs, outputs, losses)
                 # self.val()
             self.step += 1
+            self.batch_idx = batch_idx + 1
+
+            if self.opt.save_step_frequency > 0 and self.step % self.opt.save_step_frequency == 0:
+                self.save_model(checkpoint=True)
+
+            timing = self.timer.step()
+            if timing is not None and self.is_main:
+                self.log_writer.submit(self.timer.write, timing, self.step, self.writers["train"])
+
+            if profiler is not None:
+                profiler.step()
+                if profiler.step_num >= sum(self.opt.profile_steps):
+                    profiler.stop()
+                    profiler = None
+                    self.profile = False
+
+        if profiler is not None:
+            # the epoch ended before the profiling window did
+            profiler.stop()
+            self.profile = False
+
+        print("Waited {:.1f}s on data during epoch {}".format(
+            self.train_prefetcher.wait_time, self.epoch))
+
+    def start_profiler(self):
+        """Start a torch.profiler capture of the `--profile_steps` (wait, warmup, active)
+        window, exported by `save_profile` once the active steps are recorded
+        """
+        wait, warmup, active = self.opt.profile_steps
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=self.save_profile,
+            record_shapes=True,
+            profile_memory=True)
+        profiler.start()
+        return profiler
+
+    def save_profile(self, profiler):
+        """Export the chrome trace and the per-operator tables of a profiling window into
+        <log_path>/profile, and print the top operators by self time and memory
+        """
+        profile_dir = os.path.join(self.log_path, "profile")
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.export_chrome_trace(
+            os.path.join(profile_dir, "trace_step{}.json".format(self.step)))
+
+        device = "cuda" if self.device.type == "cuda" else "cpu"
+        averages = profiler.key_averages()
+        tables = {
+            "self_cpu_time": averages.table(sort_by="self_cpu_time_total", row_limit=-1),
+            "self_{}_memory".format(device): averages.table(
+                sort_by="self_{}_memory_usage".format(device), row_limit=-1),
+            "by_input_shape": profiler.key_averages(group_by_input_shape=True).table(
+                sort_by="self_cpu_time_total", row_limit=-1),
+        }
+        if device == "cuda":
+            tables["self_cuda_time"] = averages.table(
+                sort_by="self_cuda_time_total", row_limit=-1)
+        for name, table in tables.items():
+            with open(os.path.join(profile_dir, "operators_{}.txt".format(name)), "w") as f:
+                f.write(table)
+
+        summary = "\n".join([
+            "Top operators by self {} time:".format(device),
+            averages.table(sort_by="self_{}_time_total".format(device), row_limit=15),
+            "Top operators by self {} memory:".format(device),
+            averages.table(sort_by="self_{}_memory_usage".format(device), row_limit=15)])
+        with open(os.path.join(profile_dir, "summary.txt"), "w") as f:
+            f.write(summary)
+        print(summary)
+        print("Profile saved to:\n  ", profile_dir)
 
     def process_batch(self, inputs):
         """Pass a minibatch through the network and generate images and losses
         """
         for key, ipt in inputs.items():
+            # a no-op for batches already moved by the prefetcher
             inputs[key] = ipt.to(self.device)
             
         '''
@@ -368,39 +592,53 @@ class Trainer:
         # AutoBlur
         # =====================================
         if not self.opt.disable_auto_blur:
-            for scale in self.opt.scales:
-                for f_i in self.opt.frame_ids:
-                    inputs[('raw_color', f_i, scale)] = inputs[('color', f_i, scale)]
-                    inputs[('color', f_i, scale)] = self.auto_blur(
-                        inputs[('color', f_i, scale)])
+            with self.timer("auto_blur"):
+                # all frames of a scale are blurred together in one batched call
+                for scale in self.opt.scales:
+                    if ('raw_color', 0, scale) in inputs:
+                        # already blurred by the dataloader (--auto_blur_cache)
+                        continue
+                    raw_color = torch.cat(
+                        [inputs[('color', f_i, scale)] for f_i in self.opt.frame_ids])
+                    blurred = self.auto_blur(raw_color).chunk(len(self.opt.frame_ids))
+                    for i, f_i in enumerate(self.opt.frame_ids):
+                        inputs[('raw_color', f_i, scale)] = inputs[('color', f_i, scale)]
+                        inputs[('color', f_i, scale)] = blurred[i]
         # =====================================
 
         if self.opt.pose_model_type == "shared":
             # If we are using a shared encoder for both depth and pose (as advocated
             # in monodepthv1), then all images are fed separately through the depth encoder.
             all_color_aug = torch.cat([inputs[("color_aug", i, 0)] for i in self.opt.frame_ids])
-            all_features = self.models["encoder"](all_color_aug)
+            with self.timer("encoder"):
+                all_features = self.models["encoder"](all_color_aug)
             all_features = [torch.split(f, self.opt.batch_size) for f in all_features]
 
             features = {}
             for i, k in enumerate(self.opt.frame_ids):
                 features[k] = [f[i] for f in all_features]
 
-            outputs = self.models["depth"](features[0])
+            with self.timer("decoder"):
+                outputs = self.models["depth"](features[0])
         else:
             # Otherwise, we only feed the image with frame_id 0 through the depth encoder
-            features = self.models["encoder"](inputs["color_aug", 0, 0])
+            with self.timer("encoder"):
+                features = self.models["encoder"](inputs["color_aug", 0, 0])
             
-            outputs = self.models["depth"](features)
+            with self.timer("decoder"):
+                outputs = self.models["depth"](features)
 
         if self.opt.predictive_mask:
             outputs["predictive_mask"] = self.models["predictive_mask"](features)
 
         if self.use_pose_net:
-            outputs.update(self.predict_poses(inputs, features))
+            with self.timer("pose"):
+                outputs.update(self.predict_poses(inputs, features))
 
-        self.generate_images_pred(inputs, outputs)
-        losses = self.compute_losses(inputs, outputs)
+        with self.timer("warping"):
+            self.generate_images_pred(inputs, outputs)
+        with self.timer("loss"):
+            losses = self.compute_losses(inputs, outputs)
         
         return outputs, losses
 
@@ -409,44 +647,65 @@ class Trainer:
         """
         outputs = {}
         if self.num_pose_frames == 2:
-            # In this setting, we compute the pose to each source frame via a
-            # separate forward pass through the pose network.
+            # In this setting, we compute the pose to each source frame from the pair
+            # (source, target) through the pose network.
 
             # select what features the pose network takes as input
             if self.opt.pose_model_type == "shared":
                 pose_feats = {f_i: features[f_i] for f_i in self.opt.frame_ids}
             else:
                 pose_feats = {f_i: inputs["color_aug", f_i, 0] for f_i in self.opt.frame_ids}
-                '''MY Masking'''
-                # MASK
-                # =====================================
-                if not self.opt.disable_mask:
-                    b, _, h, w = inputs["color_aug", 0, 0].shape
-                    mask = torch.randn(b, 1, h, w) <= self.opt.mask_ratio # mask of opt.mask_ratio %
-                    for f_i in self.opt.frame_ids:
-                        pose_feats[f_i][mask.expand_as(pose_feats[f_i])]=0
-                # =====================================
-
-            for f_i in self.opt.frame_ids[1:]:
-                if f_i != "s":
+
+            # The pairs of all source frames are stacked along the batch dimension,
+            # so that the pose network runs once for all of them.
+            pose_frame_ids = [f_i for f_i in self.opt.frame_ids[1:] if f_i != "s"]
+            if pose_frame_ids:
+                pose_inputs = []
+                for f_i in pose_frame_ids:
                     # To maintain ordering we always pass frames in temporal order
                     if f_i < 0:
-                        pose_inputs = [pose_feats[f_i], pose_feats[0]]
+                        pose_inputs.append([pose_feats[f_i], pose_feats[0]])
                     else:
-                        pose_inputs = [pose_feats[0], pose_feats[f_i]]
+                        pose_inputs.append([pose_feats[0], pose_feats[f_i]])
 
-                    if self.opt.pose_model_type == "separate_resnet":
-                        pose_inputs = [self.models_pose["pose_encoder"](torch.cat(pose_inputs, 1))]
-                    elif self.opt.pose_model_type == "posecnn":
-                        pose_inputs = torch.cat(pose_inputs, 1)
+                if self.opt.pose_model_type == "shared":
+                    pose_inputs = [[torch.cat(f, 0) for f in zip(*feats)] for feats in zip(*pose_inputs)]
+                else:
+                    pose_inputs = torch.cat([torch.cat(pair, 1) for pair in pose_inputs], 0)
+                    '''MY Masking'''
+                    # MASK
+                    # =====================================
+                    if not self.opt.disable_mask:
+                        # the same mask for all frames, leaving the depth inputs untouched
+                        pose_inputs = self.random_mask(pose_inputs, pose_feats[0].shape[0])
+                    # =====================================
 
-                    axisangle, translation = self.models_pose["pose"](pose_inputs)
-                    outputs[("axisangle", 0, f_i)] = axisangle
-                    outputs[("translation", 0, f_i)] = translation
+                if self.opt.pose_model_type == "separate_resnet":
+                    if self.opt.batch_pose_encoder:
+                        pose_features = self.models_pose["pose_encoder"](pose_inputs)
+                    else:
+                        # keep the BatchNorm statistics of each direction separate
+                        pose_features = [torch.cat(f, 0) for f in zip(*[
+                            self.models_pose["pose_encoder"](x)
+                            for x in pose_inputs.chunk(len(pose_frame_ids))])]
+                    pose_inputs = [pose_features]
 
-                    # Invert the matrix if the frame id is negative
-                    outputs[("cam_T_cam", 0, f_i)] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0], invert=(f_i < 0))
+                axisangle, translation = self.models_pose["pose"](pose_inputs)
+
+                # Invert the matrix if the frame id is negative, for all frames at once
+                invert = torch.tensor([f_i < 0 for f_i in pose_frame_ids], device=axisangle.device)
+                cam_T_cam = transformation_from_parameters(
+                    axisangle[:, 0], translation[:, 0],
+                    invert=invert.repeat_interleave(axisangle.shape[0] // len(pose_frame_ids)))
+
+                axisangle = axisangle.chunk(len(pose_frame_ids))
+                translation = translation.chunk(len(pose_frame_ids))
+                cam_T_cam = cam_T_cam.chunk(len(pose_frame_ids))
+
+                for i, f_i in enumerate(pose_frame_ids):
+                    outputs[("axisangle", 0, f_i)] = axisangle[i]
+                    outputs[("translation", 0, f_i)] = translation[i]
+                    outputs[("cam_T_cam", 0, f_i)] = cam_T_cam[i]
 
         else:
             # Here we input all frames to the pose net (and predict all poses) together
@@ -510,12 +769,14 @@ class Trainer:
                                            [0], 4, is_train=False, img_ext=img_ext)
         # Fix batch-size = 16
         dataloader = DataLoader(dataset, 16, shuffle=False, num_workers=self.opt.num_workers,
-                                pin_memory=True, drop_last=False)
+                                pin_memory=self.device.type == "cuda", drop_last=False)
         pred_disps = []
         with torch.no_grad():
             for data in dataloader:
-                input_color = data[("color", 0, 0)].cuda()
-                output = self.models['depth'](self.models['encoder'](input_color))
+                input_color = data[("color", 0, 0)].to(self.device)
+                # unwrapped, as only the main rank evaluates
+                output = self.unwrap(self.models['depth'])(
+                    self.unwrap(self.models['encoder'])(input_color))
                 pred_disp, _ = disp_to_depth(output[("disp", 0)], self.opt.min_depth, self.opt.max_depth)
                 pred_disp = pred_disp.cpu()[:, 0].numpy()
                 pred_disps.append(pred_disp)
@@ -572,7 +833,11 @@ class Trainer:
     def generate_images_pred(self, inputs, outputs):
         """Generate the warped (reprojected) color images for a minibatch.
         Generated images are saved into the `outputs` dictionary.
+
+        All source frames are stacked along the batch dimension so that projection
+        and warping run as a single batched call per scale.
         """
+        num_sources = len(self.opt.frame_ids) - 1
         for scale in self.opt.scales:
             disp = outputs[("disp", scale)]
             if self.opt.v1_multiscale:
@@ -582,16 +847,17 @@ class Trainer:
                     disp, [self.opt.height, self.opt.width], mode="bilinear", align_corners=False)
                 source_scale = 0
 
-            _, depth = disp_to_depth(disp, self.opt.min_depth, self.opt.max_depth)
+            # scaled_disp is the inverse depth, shared by the posecnn branch below
+            scaled_disp, depth = disp_to_depth(disp, self.opt.min_depth, self.opt.max_depth)
 
             outputs[("depth", 0, scale)] = depth
 
+            T = []
             for i, frame_id in enumerate(self.opt.frame_ids[1:]):
 
                 if frame_id == "s":
-                    T = inputs["stereo_T"]
-                else:
-                    T = outputs[("cam_T_cam", 0, frame_id)]
+                    T.append(inputs["stereo_T"])
+                    continue
 
                 # from the authors of https://arxiv.org/abs/1712.00175
                 if self.opt.pose_model_type == "posecnn":
@@ -599,39 +865,81 @@ class Trainer:
                     axisangle = outputs[("axisangle", 0, frame_id)]
                     translation = outputs[("translation", 0, frame_id)]
 
-                    inv_depth = 1 / depth
-                    mean_inv_depth = inv_depth.mean(3, True).mean(2, True)
+                    mean_inv_depth = scaled_disp.mean(3, True).mean(2, True)
+
+                    T.append(transformation_from_parameters(
+                        axisangle[:, 0], translation[:, 0] * mean_inv_depth[:, 0], frame_id < 0))
+                else:
+                    T.append(outputs[("cam_T_cam", 0, frame_id)])
+
+            T = torch.cat(T, 0)
+            K = inputs[("K", source_scale)].repeat(num_sources, 1, 1)
 
-                    T = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0] * mean_inv_depth[:, 0], frame_id < 0)
+            cam_points = self.backproject_depth[source_scale](
+                depth, inputs[("inv_K", source_scale)])
+            pix_coords = self.project_3d[source_scale](cam_points, K, T)
 
-                cam_points = self.backproject_depth[source_scale](
-                    depth, inputs[("inv_K", source_scale)])
-                pix_coords = self.project_3d[source_scale](
-                    cam_points, inputs[("K", source_scale)], T)
+            outputs[("sample_stacked", scale)] = pix_coords
 
-                outputs[("sample", frame_id, scale)] = pix_coords
+            outputs[("color_stacked", scale)] = F.grid_sample(
+                self.stack_source_frames(inputs, source_scale),
+                outputs[("sample_stacked", scale)],
+                padding_mode="border", align_corners=True)
 
-                outputs[("color", frame_id, scale)] = F.grid_sample(
-                    inputs[("color", frame_id, source_scale)],
-                    outputs[("sample", frame_id, scale)],
-                    padding_mode="border", align_corners=True)
+            samples = outputs[("sample_stacked", scale)].chunk(num_sources)
+            colors = outputs[("color_stacked", scale)].chunk(num_sources)
+            for i, frame_id in enumerate(self.opt.frame_ids[1:]):
+                outputs[("sample", frame_id, scale)] = samples[i]
+                outputs[("color", frame_id, scale)] = colors[i]
 
                 if not self.opt.disable_automasking:
                     outputs[("color_identity", frame_id, scale)] = \
                         inputs[("color", frame_id, source_scale)]
 
+    def stack_source_frames(self, inputs, source_scale):
+        """Stack the source frames along the batch dimension, in `frame_ids[1:]` order.
+        The stacked tensor is cached in `inputs` so it is only built once per batch.
+        """
+        key = ("color_stacked", source_scale)
+        if key not in inputs:
+            inputs[key] = torch.cat(
+                [inputs[("color", f_i, source_scale)] for f_i in self.opt.frame_ids[1:]], 0)
+        return inputs[key]
+
+    def stack_target_frame(self, inputs, source_scale):
+        """Repeat the target frame once per source frame, to match `stack_source_frames`
+        """
+        key = ("color_target_stacked", source_scale)
+        if key not in inputs:
+            inputs[key] = inputs[("color", 0, source_scale)].repeat(
+                len(self.opt.frame_ids) - 1, 1, 1, 1)
+        return inputs[key]
+
+    def compute_identity_reprojection_losses(self, inputs, source_scale):
+        """Reprojection losses of the unwarped source frames, stacked along the channels.
+        These only depend on the inputs, so without `v1_multiscale` (where every scale
+        uses `source_scale` 0) they are computed once per batch and shared by all scales.
+        """
+        key = ("identity_reprojection_losses", source_scale)
+        if key not in inputs:
+            pred = self.stack_source_frames(inputs, source_scale)
+            target = self.stack_target_frame(inputs, source_scale)
+            inputs[key] = self.unstack_source_frames(
+                self.compute_reprojection_loss(pred, target))
+        return inputs[key]
+
+    def unstack_source_frames(self, x):
+        """Move the stacked source frames from the batch dimension to the channel dimension
+        """
+        return torch.cat(x.chunk(len(self.opt.frame_ids) - 1), 1)
+
     def compute_reprojection_loss(self, pred, target):
         """Computes reprojection loss between a batch of predicted and target images
         """
-        abs_diff = torch.abs(target - pred)
-        l1_loss = abs_diff.mean(1, True)
-
         if self.opt.no_ssim:
-            reprojection_loss = l1_loss
+            reprojection_loss = torch.abs(target - pred).mean(1, True)
         else:
-            ssim_loss = self.ssim(pred, target).mean(1, True)
-            reprojection_loss = 0.85 * ssim_loss + 0.15 * l1_loss
+            reprojection_loss = self.ssim.photometric_loss(pred, target)
 
         return reprojection_loss
 
@@ -644,7 +952,6 @@ class Trainer:
 
         for scale in self.opt.scales:
             loss = 0
-            reprojection_losses = []
 
             if self.opt.v1_multiscale:
                 source_scale = scale
@@ -663,22 +970,17 @@ class Trainer:
             color = inputs[("color", 0, scale)] if self.opt.disable_ambiguity_mask \
                 else inputs[('raw_color', 0, scale)]
             # =====================================
-            target = inputs[("color", 0, source_scale)]
+            target = self.stack_target_frame(inputs, source_scale)
 
-            for frame_id in self.opt.frame_ids[1:]:
-                pred = outputs[("color", frame_id, scale)]
-                reprojection_losses.append(self.compute_reprojection_loss(pred, target))
-
-            reprojection_losses = torch.cat(reprojection_losses, 1)
+            pred = outputs[("color_stacked", scale)]
+            with self.timer("loss/reprojection"):
+                reprojection_losses = self.unstack_source_frames(
+                    self.compute_reprojection_loss(pred, target))
 
             if not self.opt.disable_automasking:
-                identity_reprojection_losses = []
-                for frame_id in self.opt.frame_ids[1:]:
-                    pred = inputs[("color", frame_id, source_scale)]
-                    identity_reprojection_losses.append(
-                        self.compute_reprojection_loss(pred, target))
-
-                identity_reprojection_losses = torch.cat(identity_reprojection_losses, 1)
+                with self.timer("loss/identity_reprojection"):
+                    identity_reprojection_losses = self.compute_identity_reprojection_losses(
+                        inputs, source_scale)
 
                 if self.opt.avg_reprojection:
                     identity_reprojection_loss = identity_reprojection_losses.mean(1, keepdim=True)
@@ -697,7 +999,7 @@ class Trainer:
                 reprojection_losses *= mask
 
                 # add a loss pushing mask to 1 (using nn.BCELoss for stability)
-                weighting_loss = 0.2 * nn.BCELoss()(mask, torch.ones(mask.shape).cuda())
+                weighting_loss = 0.2 * autocast_fp32(nn.BCELoss())(mask, torch.ones_like(mask))
                 loss += weighting_loss.mean()
 
             if self.opt.avg_reprojection:
@@ -711,13 +1013,15 @@ class Trainer:
             # AutoBlur
             # =====================================
             if not self.opt.disable_ambiguity_mask:
-                ambiguity_mask = self.compute_ambiguity_mask(
-                    inputs, outputs, reprojection_loss, scale)
+                with self.timer("loss/ambiguity_mask"):
+                    ambiguity_mask = self.compute_ambiguity_mask(
+                        inputs, outputs, reprojection_loss, scale)
             # =====================================
 
             if not self.opt.disable_automasking:
                 # add random numbers to break ties
-                identity_reprojection_loss += torch.randn(
+                # (out of place, as the identity losses are shared across scales)
+                identity_reprojection_loss = identity_reprojection_loss + torch.randn(
                     identity_reprojection_loss.shape, device=self.device) * 0.00001
 
                 combined = torch.cat((identity_reprojection_loss, reprojection_loss), dim=1)
@@ -744,9 +1048,8 @@ class Trainer:
 
             loss += to_optimise.mean()
 
-            mean_disp = disp.mean(2, True).mean(3, True)
-            norm_disp = disp / (mean_disp + 1e-7)
-            smooth_loss = get_smooth_loss(norm_disp, color)
+            with self.timer("loss/smoothness"):
+                smooth_loss = get_smooth_loss(disp, color, normalize=True)
 
             loss += self.opt.disparity_smoothness * smooth_loss / (2 ** scale)
             
@@ -759,7 +1062,8 @@ class Trainer:
         # TripletLoss
         # =====================================
         if not self.opt.disable_triplet_loss:
-            sgt_loss = self.compute_sgt_loss(inputs, outputs)
+            with self.timer("loss/triplet"):
+                sgt_loss = self.compute_sgt_loss(inputs, outputs)
             losses['sgt_loss'] = sgt_loss
             total_loss = total_loss + sgt_loss * self.opt.sgt
         # =====================================
@@ -777,41 +1081,16 @@ class Trainer:
     # TripletLoss
     # =====================================
     def compute_sgt_loss(self, inputs, outputs):
-        seg_target = inputs[('seg', 0, 0)]
-        N, _, H, W = seg_target.shape
         total_loss = 0
 
         for s, kernel_size in zip(self.opt.sgt_scales, self.opt.sgt_kernel_size):
             # s: [3, 2, 1]
-            pad = kernel_size // 2
-            h, w = self.opt.height // 2 ** s, self.opt.width // 2 ** s
-            seg = F.interpolate(seg_target, size=(h, w), mode='nearest')
-            seg_pad = F.pad(seg, pad=[pad] * 4, value=-1)
-            patches = seg_pad.unfold(2, kernel_size, 1).unfold(3, kernel_size, 1)
-            aggregated_label = patches - seg.unsqueeze(-1).unsqueeze(-1)
-            pos_idx = (aggregated_label == 0).float()  # FIXME: misjudge anchor as positive.
-            neg_idx = (aggregated_label != 0).float()
-            pos_num = pos_idx.sum(dim=(-1, -2))
-            neg_num = neg_idx.sum(dim=(-1, -2))
-
-            is_boundary = (pos_num >= kernel_size - 1) & (neg_num >= kernel_size - 1)
-
-            feature = outputs[('d_feature', s)]
-            affinity = self.compute_affinity(feature, kernel_size=kernel_size)
-            neg_dist = neg_idx * affinity
-
-            if not self.opt.disable_hardest_neg:
-                neg_dist[neg_dist == 0] = 1e3
-                neg_dist_x, arg_min_x = torch.min(neg_dist, dim=-1)
-                neg_dist, arg_min_y = torch.min(neg_dist_x, dim=-1)
-                arg_min_x = torch.gather(arg_min_x, -1,
-                                         arg_min_y.unsqueeze(-1)).squeeze(-1)
-                neg_dist = neg_dist[is_boundary]
+            if self.opt.sgt_sparse:
+                pos_dist, neg_dist = self.compute_sparse_triplet_dist(
+                    inputs, outputs, s, kernel_size)
             else:
-                neg_dist = neg_dist.sum(dim=(-1, -2))[is_boundary] / \
-                           neg_num[is_boundary]
-
-            pos_dist = ((pos_idx * affinity).sum(dim=(-1, -2)) / pos_num)[is_boundary]
+                pos_dist, neg_dist = self.compute_dense_triplet_dist(
+                    inputs, outputs, s, kernel_size)
 
             zeros = torch.zeros(pos_dist.shape, device=self.device)
             if not self.opt.disable_isolated_triplet:
@@ -821,13 +1100,119 @@ class Trainer:
             total_loss = total_loss + loss.mean() / (2 ** s)
         return total_loss
 
-    @staticmethod
-    def compute_affinity(feature, kernel_size):
+    def compute_dense_triplet_dist(self, inputs, outputs, s, kernel_size):
+        """Positive and (hardest) negative distances of the boundary pixels,
+        computed densely over the whole feature map
+        """
+        pad = kernel_size // 2
+        h, w = self.opt.height // 2 ** s, self.opt.width // 2 ** s
+        seg = F.interpolate(inputs[('seg', 0, 0)], size=(h, w), mode='nearest')
+        seg_pad = F.pad(seg, pad=[pad] * 4, value=-1)
+
+        feature = F.normalize(outputs[('d_feature', s)], dim=1)
+        feature_pad = F.pad(feature, [pad] * 4)
+
+        # Stream over the k x k neighbourhood with shifted views instead of unfolding
+        # it, so that only N x 1 x h x w accumulators are ever materialized.
+        pos_num = torch.zeros_like(seg)
+        neg_num = torch.zeros_like(seg)
+        pos_dist = 0
+        if not self.opt.disable_hardest_neg:
+            neg_dist = torch.full_like(seg, 1e3)
+        else:
+            neg_dist = 0
+
+        for dy in range(kernel_size):
+            for dx in range(kernel_size):
+                pos_idx = (seg_pad[:, :, dy:dy + h, dx:dx + w] == seg).float()  # FIXME: misjudge anchor as positive.
+                neg_idx = 1 - pos_idx
+                pos_num += pos_idx
+                neg_num += neg_idx
+
+                affinity = self.compute_affinity(
+                    feature, feature_pad[:, :, dy:dy + h, dx:dx + w])
+                pos_dist = pos_dist + pos_idx * affinity
+
+                if not self.opt.disable_hardest_neg:
+                    neg_dist = torch.minimum(
+                        neg_dist, torch.where(neg_idx.bool(), affinity, 1e3))
+                else:
+                    neg_dist = neg_dist + neg_idx * affinity
+
+        is_boundary = (pos_num >= kernel_size - 1) & (neg_num >= kernel_size - 1)
+
+        if not self.opt.disable_hardest_neg:
+            neg_dist = neg_dist[is_boundary]
+        else:
+            neg_dist = neg_dist[is_boundary] / neg_num[is_boundary]
+
+        pos_dist = (pos_dist / pos_num)[is_boundary]
+        return pos_dist, neg_dist
+
+    def get_sgt_boundary(self, inputs, s, kernel_size):
+        """Find the segmentation boundary pixels at scale `s` and their k x k neighbourhoods.
+        Only depends on the segmentation map, so the result is cached per batch in `inputs`.
+        """
+        key = ('sgt_boundary', s)
+        if key in inputs:
+            return inputs[key]
+
+        pad = kernel_size // 2
+        h, w = self.opt.height // 2 ** s, self.opt.width // 2 ** s
+        seg = F.interpolate(inputs[('seg', 0, 0)], size=(h, w), mode='nearest')
+        seg_pad = F.pad(seg, pad=[pad] * 4, value=-1)
+
+        pos_num = torch.zeros_like(seg)
+        for dy in range(kernel_size):
+            for dx in range(kernel_size):
+                pos_num += seg_pad[:, :, dy:dy + h, dx:dx + w] == seg
+        neg_num = kernel_size ** 2 - pos_num
+        is_boundary = (pos_num >= kernel_size - 1) & (neg_num >= kernel_size - 1)
+
+        # (n, y, x) of every boundary pixel, and (y, x) of its neighbours in the padded map
+        n, _, y, x = is_boundary.nonzero(as_tuple=True)
+        offsets = torch.arange(kernel_size, device=seg.device)
+        offset_y, offset_x = torch.meshgrid(offsets, offsets, indexing='ij')
+        neighbour_y = y.unsqueeze(1) + offset_y.reshape(1, -1)
+        neighbour_x = x.unsqueeze(1) + offset_x.reshape(1, -1)
+
+        neighbour_label = seg_pad[n.unsqueeze(1), 0, neighbour_y, neighbour_x]
+        pos_idx = (neighbour_label == seg[n, 0, y, x].unsqueeze(1)).float()  # FIXME: misjudge anchor as positive.
+
+        inputs[key] = (n, y, x, neighbour_y, neighbour_x, pos_idx)
+        return inputs[key]
+
+    def compute_sparse_triplet_dist(self, inputs, outputs, s, kernel_size):
+        """Positive and (hardest) negative distances of the boundary pixels,
+        computed only on the gathered M x k^2 neighbourhoods of the M boundary pixels
+        """
+        n, y, x, neighbour_y, neighbour_x, pos_idx = self.get_sgt_boundary(inputs, s, kernel_size)
+        neg_idx = 1 - pos_idx
+
         pad = kernel_size // 2
-        feature = F.normalize(feature, dim=1)
-        unfolded = F.pad(feature, [pad] * 4).unfold(2, kernel_size, 1).unfold(3, kernel_size, 1)
-        feature = feature.unsqueeze(-1).unsqueeze(-1)
-        similarity = (feature * unfolded).sum(dim=1, keepdim=True)
+        feature = outputs[('d_feature', s)]
+        feature_pad = F.pad(feature, [pad] * 4)
+
+        # zero padding stays zero after normalization, as in the dense computation
+        anchor = F.normalize(feature[n, :, y, x], dim=-1).unsqueeze(1)
+        neighbour = F.normalize(
+            feature_pad[n.unsqueeze(1), :, neighbour_y, neighbour_x], dim=-1)
+        affinity = self.compute_affinity(anchor, neighbour, dim=-1)
+
+        if not self.opt.disable_hardest_neg:
+            neg_dist, _ = torch.where(neg_idx.bool(), affinity, 1e3).min(dim=-1)
+        else:
+            neg_dist = (neg_idx * affinity).sum(dim=-1) / neg_idx.sum(dim=-1)
+
+        pos_dist = (pos_idx * affinity).sum(dim=-1) / pos_idx.sum(dim=-1)
+        return pos_dist, neg_dist
+
+    @staticmethod
+    @autocast_fp32
+    def compute_affinity(feature, neighbour, dim=1):
+        """Distance between L2-normalized features and their neighbours along `dim`
+        """
+        similarity = (feature * neighbour).sum(dim=dim, keepdim=dim == 1)
         affinity = torch.clamp(2 - 2 * similarity, min=1e-9).sqrt()
         return affinity
     # =====================================
@@ -864,18 +1249,18 @@ class Trainer:
         src_scale = scale if self.opt.v1_multiscale else 0
         min_reproj, min_idx = torch.min(reprojection_loss, dim=1)
 
-        target_ambiguity = self.extract_ambiguity(inputs[("color", 0, src_scale)])
-
-        reproj_ambiguities = []
-        for f_i in self.opt.frame_ids[1:]:
-            src_ambiguity = self.extract_ambiguity(inputs[("color", f_i, src_scale)])
-
-            reproj_ambiguity = F.grid_sample(
-                src_ambiguity, outputs[("sample", f_i, scale)],
-                padding_mode="border", align_corners=True)
-            reproj_ambiguities.append(reproj_ambiguity)
-
-        reproj_ambiguities = torch.cat(reproj_ambiguities, dim=1)
+        # the ambiguities only depend on the inputs, so compute them once per source scale
+        if ("ambiguity", 0, src_scale) not in inputs:
+            inputs[("ambiguity", 0, src_scale)] = self.extract_ambiguity(
+                inputs[("color", 0, src_scale)])
+            inputs[("ambiguity_stacked", src_scale)] = self.extract_ambiguity(
+                self.stack_source_frames(inputs, src_scale))
+        target_ambiguity = inputs[("ambiguity", 0, src_scale)]
+        src_ambiguity = inputs[("ambiguity_stacked", src_scale)]
+
+        reproj_ambiguities = self.unstack_source_frames(F.grid_sample(
+            src_ambiguity, outputs[("sample_stacked", scale)],
+            padding_mode="border", align_corners=True))
         reproj_ambiguity = torch.gather(reproj_ambiguities, 1, min_idx.unsqueeze(1))
 
         synthetic_ambiguity, _ = torch.cat(
@@ -895,10 +1280,11 @@ class Trainer:
         This isn't particularly accurate as it averages over the entire batch,
         so is only used to give an indication of validation performance
         """
-        depth_pred = outputs[("depth", 0, 0)]
+        # the full resolution depth of generate_images_pred, detached before resizing so
+        # that autograd does not record the resize
+        depth_pred = outputs[("depth", 0, 0)].detach().float()
         depth_pred = torch.clamp(F.interpolate(
             depth_pred, [375, 1242], mode="bilinear", align_corners=False), 1e-3, 80)
-        depth_pred = depth_pred.detach()
 
         depth_gt = inputs["depth_gt"]
         mask = depth_gt > 0
@@ -914,10 +1300,10 @@ class Trainer:
 
         depth_pred = torch.clamp(depth_pred, min=1e-3, max=80)
 
-        depth_errors = compute_depth_errors(depth_gt, depth_pred)
+        depth_errors = torch.stack(compute_depth_errors(depth_gt, depth_pred)).cpu().numpy()
 
         for i, metric in enumerate(self.depth_metric_names):
-            losses[metric] = np.array(depth_errors[i].cpu())
+            losses[metric] = depth_errors[i]
         
     def log_time(self, batch_idx, duration, loss):
         """Print a logging statement to the terminal
@@ -927,54 +1313,82 @@ class Trainer:
         training_time_left = (
             self.num_total_steps / self.step - 1.0) * time_sofar if self.step > 0 else 0
         print_string = "epoch {:>3} | lr {:.6f} |lr_p {:.6f} | batch {:>6} | examples/s: {:5.1f}" + \
-            " | loss: {:.5f} | time elapsed: {} | time left: {}"
+            " | loss: {:.5f} | data wait: {:.3f}s | time elapsed: {} | time left: {}"
         print(print_string.format(self.epoch, self.model_optimizer.state_dict()['param_groups'][0]['lr'],
                                   self.model_pose_optimizer.state_dict()['param_groups'][0]['lr'],
-                                  batch_idx, samples_per_sec, loss,
+                                  batch_idx, samples_per_sec, loss, self.train_prefetcher.last_wait,
                                   sec_to_hm_str(time_sofar), sec_to_hm_str(training_time_left)))
 
     def log(self, mode, inputs, outputs, losses):
         """Write an event to the tensorboard events file
+
+        The logged scalars and images are gathered with a single device to host copy
+        and written by the log writer thread.
+        """
+        n = min(4, self.opt.batch_size)  # write a maxmimum of four images
+        tensors = {}
+        scalars = {}
+        for l, v in losses.items():
+            if torch.is_tensor(v):
+                tensors[l] = v.detach()
+            else:
+                scalars[l] = float(v)
+
+        images = {}
+        for s in self.opt.scales:
+            for frame_id in self.opt.frame_ids:
+                images["color_{}_{}".format(frame_id, s)] = inputs[("color", frame_id, s)][:n]
+                if s == 0 and frame_id != 0:
+                    images["color_pred_{}_{}".format(frame_id, s)] = \
+                        outputs[("color", frame_id, s)][:n]
+
+            # batched normalize_image
+            disp = outputs[("disp", s)][:n].detach().float()
+            mi = disp.amin((1, 2, 3), keepdim=True)
+            d = disp.amax((1, 2, 3), keepdim=True) - mi
+            images["disp_{}".format(s)] = (disp - mi) / torch.where(d > 0, d, torch.full_like(d, 1e5))
+
+            if self.opt.predictive_mask:
+                for f_idx, frame_id in enumerate(self.opt.frame_ids[1:]):
+                    images["predictive_mask_{}_{}".format(frame_id, s)] = \
+                        outputs["predictive_mask"][("disp", s)][:n, f_idx:f_idx + 1]
+
+            elif not self.opt.disable_automasking:
+                images["automask_{}".format(s)] = \
+                    outputs["identity_selection/{}".format(s)][:n, None]
+
+        # one copy for everything, then split back on the host
+        keys = list(tensors) + list(images)
+        values = [tensors[k] for k in tensors] + [images[k] for k in images]
+        flat = torch.cat([v.detach().float().reshape(-1) for v in values]).cpu().numpy()
+        offsets = np.cumsum([v.numel() for v in values])[:-1]
+        for k, v, x in zip(keys, values, np.split(flat, offsets)):
+            if k in tensors:
+                scalars[k] = float(x[0])
+            else:
+                images[k] = x.reshape(v.shape)
+
+        self.log_writer.submit(self.write_log, mode, self.step, scalars, images)
+
+    def write_log(self, mode, step, scalars, images):
+        """Write the host copies gathered by `log`, on the log writer thread
         """
         writer = self.writers[mode]
         # MY_FIX: Wandb Log Metrics for train & val
         # =====================================
         wandb_dict = {}
-        for l, v in losses.items():
-            writer.add_scalar("{}".format(l), v, self.step)
+        for l, v in scalars.items():
+            writer.add_scalar("{}".format(l), v, step)
             if mode == 'train':
                 wandb_dict.update({l:v})
             else:
                 wandb_dict.update({(l+'_val'):v})
-        self.wandb.log(wandb_dict)
+        self.metrics.log(wandb_dict, step)
         # =====================================
 
-        for j in range(min(4, self.opt.batch_size)):  # write a maxmimum of four images
-            for s in self.opt.scales:
-                for frame_id in self.opt.frame_ids:
-                    writer.add_image(
-                        "color_{}_{}/{}".format(frame_id, s, j),
-                        inputs[("color", frame_id, s)][j].data, self.step)
-                    if s == 0 and frame_id != 0:
-                        writer.add_image(
-                            "color_pred_{}_{}/{}".format(frame_id, s, j),
-                            outputs[("color", frame_id, s)][j].data, self.step)
-
-                writer.add_image(
-                    "disp_{}/{}".format(s, j),
-                    normalize_image(outputs[("disp", s)][j]), self.step)
-
-                if self.opt.predictive_mask:
-                    for f_idx, frame_id in enumerate(self.opt.frame_ids[1:]):
-                        writer.add_image(
-                            "predictive_mask_{}_{}/{}".format(frame_id, s, j),
-                            outputs["predictive_mask"][("disp", s)][j, f_idx][None, ...],
-                            self.step)
-
-                elif not self.opt.disable_automasking:
-                    writer.add_image(
-                        "automask_{}/{}".format(s, j),
-                        outputs["identity_selection/{}".format(s)][j][None, ...], self.step)
+        for tag, batch in images.items():
+            for j in range(batch.shape[0]):
+                writer.add_image("{}/{}".format(tag, j), batch[j], step)
 
     def save_opts(self):
         """Save options to disk so we know what we ran this experiment with
@@ -987,47 +1401,120 @@ class Trainer:
         with open(os.path.join(models_dir, 'opt.json'), 'w') as f:
             json.dump(to_save, f, indent=2)
     
-    def save_model(self, checkpoint=False):
+    def save_model(self, checkpoint=False, metrics=None):
         """Save model weights to disk
+
+        The state dicts are snapshotted to CPU here and written by the checkpoint writer
+        thread, see `CheckpointWriter`. Only the main rank saves.
         """
+        if not self.is_main:
+            return
+
         '''ORIGINAL'''
         # ORIGINAL
         # save_folder = os.path.join(self.log_path, "models", "weights_{}".format(self.best_models['epoch']))
         '''MY'''
         # MY_FIX: Save model into best and only save one best model.
         # =====================================
-        save_folder = os.path.join(self.log_path, "models", 'best')
-        if checkpoint:
-            save_folder = save_folder.replace('best', 'checkpoint')
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
+        # models/best always points to the single best model, models/checkpoint to the
+        # latest of the last `num_checkpoints` checkpoints
+        name = 'checkpoint' if checkpoint else 'best'
+        keep = self.opt.num_checkpoints if checkpoint else 1
         # =====================================
 
+        # completed epochs, the position within the current one is in the training state
+        state = self.training_state() if checkpoint else None
+
+        to_save = {}
         for model_name, model in self.models.items():
-            save_path = os.path.join(save_folder, "{}.pth".format(model_name))
-            to_save = model.state_dict()
+            to_save[model_name] = self.unwrap(model).state_dict()
             if model_name == 'encoder':
                 # save the sizes - these are needed at prediction time
-                to_save['height'] = self.opt.height
-                to_save['width'] = self.opt.width
-                to_save['use_stereo'] = self.opt.use_stereo
+                to_save[model_name]['height'] = self.opt.height
+                to_save[model_name]['width'] = self.opt.width
+                to_save[model_name]['use_stereo'] = self.opt.use_stereo
                 if checkpoint:
-                    to_save['epoch'] = self.opt.num_epochs
-            torch.save(to_save, save_path)
+                    to_save[model_name]['epoch'] = state["epoch"]
 
         for model_name, model in self.models_pose.items():
-            save_path = os.path.join(save_folder, "{}.pth".format(model_name))
-            to_save = model.state_dict()
+            to_save[model_name] = self.unwrap(model).state_dict()
             if checkpoint:
-                to_save['epoch'] = self.opt.num_epochs
-            torch.save(to_save, save_path)
+                to_save[model_name]['epoch'] = state["epoch"]
+
+        to_save["adam"] = self.model_optimizer.state_dict()
+        if self.use_pose_net:
+            to_save["adam_pose"] = self.model_pose_optimizer.state_dict()
 
-        save_path = os.path.join(save_folder, "{}.pth".format("adam"))
-        torch.save(self.model_optimizer.state_dict(), save_path)
+        if checkpoint:
+            to_save["trainer_state"] = state
 
-        save_path = os.path.join(save_folder, "{}.pth".format("adam_pose"))
+        self.checkpoint_writer.save(name, to_save, self.step, metrics=metrics, keep=keep)
+
+    def training_state(self):
+        """Everything besides the model and optimizer weights needed to resume training:
+        position in the schedule, best metrics, schedulers, loss scaler and RNG states
+        """
+        if self.epoch_finished:
+            epoch, batch_idx = self.epoch + 1, 0
+        else:
+            epoch, batch_idx = self.epoch, self.batch_idx
+
+        np_state = np.random.get_state()
+        rng = {
+            "python": random.getstate(),
+            # as plain lists, so that loading does not need to unpickle numpy arrays
+            "numpy": [np_state[0], np_state[1].tolist()] + list(np_state[2:]),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        }
+        if self.use_pose_net and not self.opt.disable_mask:
+            rng["mask"] = {str(device): generator.get_state()
+                           for device, generator in self.random_mask.generators.items()}
+
+        state = {
+            "epoch": epoch,
+            "batch_idx": batch_idx,
+            "step": self.step,
+            "best_models": dict(self.best_models),
+            "model_lr_scheduler": self.model_lr_scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "rng": rng,
+        }
+        if self.use_pose_net:
+            state["model_pose_lr_scheduler"] = self.model_pose_lr_scheduler.state_dict()
+        return state
+
+    def load_training_state(self):
+        """Restore the state saved by `training_state` from the `load_weights_folder`
+        checkpoint, whose weights were already loaded by `load_model`
+        """
+        assert self.opt.load_weights_folder is not None, \
+            "--resume needs the checkpoint to resume from as --load_weights_folder"
+        path = os.path.join(self.opt.load_weights_folder, "trainer_state.pth")
+        assert os.path.isfile(path), "Cannot find training state {}".format(path)
+        state = torch.load(path, map_location="cpu")
+
+        self.epoch = state["epoch"]
+        self.batch_idx = state["batch_idx"]
+        self.step = state["step"]
+        self.best_models.update(state["best_models"])
+        self.model_lr_scheduler.load_state_dict(state["model_lr_scheduler"])
         if self.use_pose_net:
-            torch.save(self.model_pose_optimizer.state_dict(), save_path)
+            self.model_pose_lr_scheduler.load_state_dict(state["model_pose_lr_scheduler"])
+        self.scaler.load_state_dict(state["scaler"])
+
+        rng = state["rng"]
+        random.setstate(rng["python"])
+        np.random.set_state((rng["numpy"][0], np.array(rng["numpy"][1], dtype=np.uint32))
+                            + tuple(rng["numpy"][2:]))
+        torch.set_rng_state(rng["torch"])
+        if rng["cuda"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng["cuda"])
+        for device, generator_state in rng.get("mask", {}).items():
+            self.random_mask.get_generator(torch.device(device)).set_state(generator_state)
+
+        print("Resuming training from epoch {} batch {} (step {})".format(
+            self.epoch, self.batch_idx, self.step))
 
     def load_pretrain(self):
         self.opt.mypretrain = os.path.expanduser(self.opt.mypretrain)